@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Make a batch of pieces (or single songs) without a GUI and report how fast it went.
+
+    python batch.py 20 --out output --formats musicxml,midi,json --processes 8
+    python batch.py 500 --songs --formats midi --seed 1 --report timings.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+from multiprocessing import Pool
+from collections import defaultdict
+
+import midi_writer
+import musicxml_writer
+from montreal import Piece, Song, Instruments
+from tracing import Tracer, NULL_TRACER
+
+
+FORMATS = ['musicxml', 'midi', 'json']
+
+
+def write_json(piece, filename):
+    with open(filename, 'w') as f:
+        json.dump({
+            'title': piece.title,
+            'composer': piece.composer,
+            'seed': piece.seed,
+            'songs': [song.to_dict() for song in piece.songs]
+        }, f)
+
+
+WRITERS = {
+    'musicxml': ('xml', musicxml_writer.write_file),
+    'midi': ('mid', midi_writer.write_file),
+    'json': ('json', write_json)
+}
+
+
+_instruments = None
+
+
+def make(job):
+    """Make and write one piece or song. Returns its stage timings in seconds, and its tracer."""
+    global _instruments
+    if _instruments is None:
+        _instruments = Instruments()
+
+    index, seed, songs_only, out, formats, trace = job
+    tracer = Tracer() if trace else NULL_TRACER
+    timings = {}
+
+    start = time.time()
+    if songs_only:
+        song = Song(_instruments, seed=seed, tracer=tracer)
+        piece = Piece(notation=False, seed=seed, songs=[song], tracer=tracer)
+        name = 'song_{:05d}'.format(index)
+    else:
+        piece = Piece(notation=False, seed=seed, tracer=tracer)
+        name = 'piece_{:05d}'.format(index)
+    timings['generate'] = time.time() - start
+
+    for fmt in formats:
+        extension, writer = WRITERS[fmt]
+        start = time.time()
+        with tracer.span('write', format=fmt):
+            writer(piece, os.path.join(out, '{}.{}'.format(name, extension)))
+        timings[fmt] = time.time() - start
+
+    return len(piece.songs), timings, tracer
+
+
+def run(n, songs_only=False, out='output', formats=FORMATS, processes=1, seed=None, tracer=NULL_TRACER):
+    """
+    Make `n` pieces (or songs) into `out`. Returns a report of counts, rates and stage timings.
+    The spans from every piece are merged into `tracer`.
+    """
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    seeds = random.Random(seed)
+    jobs = [(i, seeds.getrandbits(32), songs_only, out, formats, tracer.enabled) for i in range(n)]
+
+    start = time.time()
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(make, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [make(job) for job in jobs]
+    elapsed = time.time() - start
+
+    stages = defaultdict(float)
+    num_songs = 0
+    for song_count, timings, piece_tracer in results:
+        num_songs += song_count
+        tracer.merge(piece_tracer)
+        for stage, seconds in timings.items():
+            stages[stage] += seconds
+
+    return {
+        'items': n,
+        'kind': 'songs' if songs_only else 'pieces',
+        'songs': num_songs,
+        'processes': processes,
+        'seed': seed,
+        'formats': formats,
+        'seconds': elapsed,
+        'pieces_per_second': 0.0 if songs_only else n / elapsed,
+        'songs_per_second': num_songs / elapsed,
+        'stages': dict(stages)
+    }
+
+
+def print_report(report):
+    print '{} {} ({} songs) in {:.2f}s with {} process(es)'.format(
+        report['items'], report['kind'], report['songs'], report['seconds'], report['processes'])
+    if report['kind'] == 'pieces':
+        print '{:.3f} pieces/sec'.format(report['pieces_per_second'])
+    print '{:.3f} songs/sec'.format(report['songs_per_second'])
+    print 'Stage totals (summed over workers):'
+    for stage, seconds in sorted(report['stages'].items(), key=lambda s: -s[1]):
+        print '  {:<10} {:8.3f}s'.format(stage, seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Make a batch of pieces or songs.')
+    parser.add_argument('n', type=int, help='how many pieces (or songs) to make')
+    parser.add_argument('--songs', action='store_true', help='make single songs instead of whole pieces')
+    parser.add_argument('--out', default='output', help='output directory')
+    parser.add_argument('--formats', default='musicxml,midi,json',
+                        help='comma separated, any of: {}'.format(', '.join(FORMATS)))
+    parser.add_argument('--processes', type=int, default=1, help='worker processes')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the whole batch')
+    parser.add_argument('--report', help='also write the report to this JSON file')
+    parser.add_argument('--trace', help='write per-stage spans to this file in Chrome trace format')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log each song, or with -vv every melody note decision')
+    args = parser.parse_args(argv)
+
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(args.verbose, 2)], format='%(processName)s %(message)s')
+
+    formats = [f for f in args.formats.split(',') if f]
+    for f in formats:
+        if f not in WRITERS:
+            parser.error('unknown format {!r}'.format(f))
+
+    tracer = Tracer() if args.trace else NULL_TRACER
+    report = run(args.n, args.songs, args.out, formats, args.processes, args.seed, tracer)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.trace:
+        tracer.write_chrome_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Timings for each stage of generating a piece, seeded so runs can be compared.
+
+    python benchmarks.py --json before.json
+    ... change something ...
+    python benchmarks.py --json after.json --compare before.json
+    python benchmarks.py --filter song_forms
+
+Every benchmark is a function that does its setup and returns (function to time, number of calls
+per repeat), plus a function to clean up afterwards if it needs one. Results are the best, median and mean seconds per call over the repeats.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import multiprocessing
+import argparse
+import datetime
+import subprocess
+from timeit import default_timer
+
+SEED = 1
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench_weighted_choice():
+    from utils import weighted_choice
+    from harmonic_rhythm import options_8, weights_8
+    rng = random.Random(SEED)
+    return lambda: weighted_choice(options_8, weights_8, rng), 2000
+
+
+def bench_weighted_sampler():
+    from utils import WeightedSampler
+    from harmonic_rhythm import options_8, weights_8
+    sampler = WeightedSampler(options_8, weights_8)
+    rng = random.Random(SEED)
+    return lambda: sampler.choose(rng), 2000
+
+
+def bench_harmonic_rhythm_choose_8():
+    import harmonic_rhythm
+    rng = random.Random(SEED)
+    return lambda: harmonic_rhythm.choose(8, rng), 2000
+
+
+def _import_song_forms(cache_dir):
+    env = dict(os.environ, MONTREAL_CACHE_DIR=cache_dir)
+    # Importing alone is lazy, so make the first draw too
+    subprocess.check_call([sys.executable, '-c', 'import song_forms; song_forms.choose()'], cwd=HERE, env=env)
+
+
+def bench_song_forms_import_cold():
+    def run():
+        cache_dir = tempfile.mkdtemp()
+        try:
+            _import_song_forms(cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
+    return run, 1
+
+
+def bench_song_forms_import_warm():
+    cache_dir = tempfile.mkdtemp()
+    _import_song_forms(cache_dir)
+    return lambda: _import_song_forms(cache_dir), 1, lambda: shutil.rmtree(cache_dir)
+
+
+# Modules that generating songs and writing them natively must never import
+HEAVY_MODULES = ['music21', 'numpy']
+
+
+def _import(statement):
+    subprocess.check_call([sys.executable, '-c', statement], cwd=HERE)
+
+
+def bench_import_core():
+    # Fails if anything heavy creeps back into the imports, rather than just getting slower
+    check = 'import sys; heavy = [m for m in {!r} if m in sys.modules]; assert not heavy, heavy'.format(
+        HEAVY_MODULES)
+    return lambda: _import('import montreal, midi_writer, musicxml_writer, batch; ' + check), 1
+
+
+def bench_import_notation():
+    return lambda: _import('import montreal, notation'), 1
+
+
+def bench_song_forms_choose():
+    import song_forms
+    rng = random.Random(SEED)
+    song_forms.choose(rng)
+    return lambda: song_forms.choose(rng), 2000
+
+
+def bench_form_choose():
+    import form
+    rng = random.Random(SEED)
+    form.get_catalogue()
+    return lambda: form.choose(rng), 2000
+
+
+def bench_form_choose_filtered():
+    import form
+    rng = random.Random(SEED)
+    form.get_catalogue()
+    return lambda: form.choose(rng, max_duration=40), 2000
+
+
+def _song():
+    from montreal import Song, Instruments
+    return Song(Instruments(), seed=SEED)
+
+
+def bench_choose_melody_pitches():
+    from utils import Event
+    song = _song()
+    bar_types = [song.form.bar_types[name] for name in sorted(song.form.bar_types)]
+    # Only the notes from the rhythm, not the ornaments added afterwards
+    jobs = [([Event(duration=note['duration']) for note in bar_type.parts[0]['notes']
+              if note['duration']], bar_type.parts[1]['notes']) for bar_type in bar_types]
+
+    def run():
+        song.rng.seed(SEED)
+        for notes, harmonies in jobs:
+            song.choose_melody_pitches(notes, song.vln_register, harmonies)
+    return run, 20
+
+
+def bench_get_simul():
+    from utils import get_simul, check_get_simul
+    # No point timing it if it's wrong
+    check_get_simul(rng=random.Random(SEED))
+    song = _song()
+    bars = [[part['notes'] for part in bar.parts] for bar in song.bars]
+
+    def run():
+        for parts in bars:
+            get_simul(parts)
+    return run, 20
+
+
+def bench_split_at_beats():
+    from utils import split_at_beats, join_quarters
+    song = _song()
+    durations = [[note['duration'] for note in part['notes']] for bar in song.bars for part in bar.parts]
+
+    def run():
+        for durs in durations:
+            [join_quarters(components) for components in split_at_beats(durs)]
+    return run, 20
+
+
+def bench_split_durations_uncached():
+    import utils
+    song = _song()
+    durations = [[note['duration'] for note in part['notes']] for bar in song.bars for part in bar.parts]
+
+    def run():
+        utils._split_durations_cache.clear()
+        for durs in durations:
+            utils.split_durations(durs)
+    return run, 20
+
+
+def bench_song():
+    from montreal import Song, Instruments
+    instruments = Instruments()
+    seeds = random.Random(SEED)
+    return lambda: Song(instruments, seed=seeds.getrandbits(32)), 20
+
+
+def _piece():
+    from montreal import Piece
+    return Piece(seed=SEED, notation=False)
+
+
+def bench_piece_generation():
+    return _piece, 1
+
+
+def bench_piece_notation():
+    piece = _piece()
+    return piece.make_notation, 1
+
+
+def bench_export_musicxml_native():
+    import musicxml_writer
+    from StringIO import StringIO
+    piece = _piece()
+    return lambda: musicxml_writer.write(piece, StringIO()), 3
+
+
+def bench_export_midi_native():
+    import midi_writer
+    from StringIO import StringIO
+    piece = _piece()
+    return lambda: midi_writer.write(piece, StringIO()), 3
+
+
+def bench_export_musicxml_music21():
+    piece = _piece()
+    piece.make_notation()
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'piece.xml')
+    return lambda: piece.score.write('musicxml', filename), 1, lambda: shutil.rmtree(directory)
+
+
+BATCH_PIECES = 8
+
+
+def _batch(processes):
+    import batch
+    directory = tempfile.mkdtemp()
+    run = lambda: batch.run(BATCH_PIECES, out=directory, formats=['midi'], processes=processes, seed=SEED)
+    return run, 1, lambda: shutil.rmtree(directory)
+
+
+def bench_batch_serial():
+    return _batch(1)
+
+
+def bench_batch_parallel():
+    # Pieces are the unit of parallel work (see batch.py), so compare with batch_serial
+    return _batch(max(2, multiprocessing.cpu_count()))
+
+
+BENCHMARKS = sorted((name[len('bench_'):], f) for name, f in globals().items() if name.startswith('bench_'))
+
+
+def time_benchmark(setup, repeat):
+    benchmark = setup()
+    run, number = benchmark[:2]
+    times = []
+    try:
+        for _ in range(repeat):
+            start = default_timer()
+            for _ in range(number):
+                run()
+            times.append((default_timer() - start) / number)
+    finally:
+        if len(benchmark) > 2:
+            benchmark[2]()
+    times.sort()
+    return {
+        'best': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'repeat': repeat,
+        'number': number
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, repeat=5, quick=False):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        if quick and name == 'export_musicxml_music21':
+            continue
+        random.seed(SEED)
+        results[name] = time_benchmark(setup, repeat)
+        sys.stderr.write('{:<32} {:12.6f}s\n'.format(name, results[name]['best']))
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'seed': SEED,
+        'results': results
+    }
+
+
+def compare(old, new):
+    print '{:<32} {:>12} {:>12} {:>8}'.format('benchmark', 'old', 'new', 'ratio')
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a = old['results'][name]['best']
+        b = new['results'][name]['best']
+        print '{:<32} {:12.6f} {:12.6f} {:8.2f}'.format(name, a, b, b / a if a else float('inf'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each stage of generating a piece.')
+    parser.add_argument('--filter', action='append', help='only run benchmarks with this in their name')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='skip the slow music21 export')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare against results from an earlier --json')
+    args = parser.parse_args(argv)
+
+    report = run(args.filter, args.repeat, args.quick)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -62,9 +62,9 @@ OTHERS = [
     (0, 3, 5, 10)
 ]
 
-def get_random_valids():
-    number = random.randint(4, 7)
-    harmonies = random.sample(OTHERS, number)
+def get_random_valids(rng=random):
+    number = rng.randint(4, 7)
+    harmonies = rng.sample(OTHERS, number)
     # harmonies = []
     # while len(harmonies) < number:
     #     harmony = get_random_harmony()
@@ -73,19 +73,19 @@ def get_random_valids():
     return harmonies
 
 
-def get_harmony_generator():
-    other_harmonies = get_random_valids()
+def get_harmony_generator(rng=random):
+    other_harmonies = get_random_valids(rng)
 
-    if random.random() < .7:
+    if rng.random() < .7:
         # fewer other harmonies
-        percent_other = scale(random.random(), 0, 1, 0.0, 0.1)
+        percent_other = scale(rng.random(), 0, 1, 0.0, 0.1)
 
     else:
         # more other harmonies
-        percent_other = scale(random.random(), 0, 1, 0.1, 0.6)
+        percent_other = scale(rng.random(), 0, 1, 0.1, 0.6)
 
     while True:
-        if random.random() < percent_other:
-            yield random.choice(other_harmonies)
+        if rng.random() < percent_other:
+            yield rng.choice(other_harmonies)
         else:
-            yield context_free_harmony.choose()
+            yield context_free_harmony.choose(rng)
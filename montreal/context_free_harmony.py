@@ -1,4 +1,6 @@
-from utils import weighted_choice
+import random
+
+from utils import WeightedSampler
 
 chord_types = [
     (0, 4, 7),
@@ -23,13 +25,14 @@ class Expandable(object):
         self.type = 'expandable'
         self.weights = weights
         self.options = options
+        self.sampler = WeightedSampler(options, weights)
 
-    def choose(self):
-        choice = weighted_choice(self.options, self.weights)
+    def choose(self, rng=random):
+        choice = self.sampler.choose(rng)
         if choice.type == 'terminal':
             return choice.value
         else:
-            return choice.choose()
+            return choice.choose(rng)
 
 
 tree = Expandable([.6, .4], [
@@ -51,5 +54,5 @@ tree = Expandable([.6, .4], [
 ])
 
 
-def choose():
-    return tree.choose()
+def choose(rng=random):
+    return tree.choose(rng)
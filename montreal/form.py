@@ -1,4 +1,10 @@
+import os
+import sys
+import json
 import random
+from bisect import bisect_left, bisect_right
+
+from utils import to_ticks
 
 """
 Ignore this
@@ -55,6 +61,7 @@ class Form(object):
             bar.type_obj = self.bar_types[bar.type]
 
         self.duration = sum([b.duration for b in self.bars])
+        self.ticks = to_ticks(self.duration)
 
     def __repr__(self):
         return self.form_string
@@ -67,6 +74,10 @@ class Bar(object):
         self.duration = 2
         self.tempo = None
 
+    @property
+    def ticks(self):
+        return to_ticks(self.duration)
+
     def __repr__(self):
         return '{}{}'.format(self.type, self.duration)
 
@@ -75,6 +86,7 @@ class BarType(object):
     def __init__(self, name, duration):
         self.name = name
         self.duration = duration
+        self.ticks = to_ticks(duration)
 
         self.parts = [
             {
@@ -90,19 +102,117 @@ class BarType(object):
 
 
 
-def parse_file():
-    filename = '/Users/jmarmor/repos/jonathanmarmor/montreal/montreal/forms.txt'
-    return [Form(line) for line in open(filename)]
-
-
-FORMS = parse_file()
-
-
-def choose():
-    return random.choice(FORMS)
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The forms as written, one per line
+SOURCE = os.path.join(HERE, 'forms.txt')
+
+# The same forms pre-parsed and indexed, made from SOURCE by `python form.py build`
+CATALOGUE = os.path.join(HERE, 'forms.json')
+
+
+def parse_file(filename=SOURCE):
+    return [Form(line) for line in open(filename) if line.strip()]
+
+
+def build_catalogue(source=SOURCE, filename=CATALOGUE):
+    """
+    Write the forms in `source` to `filename` with, for each form, its duration in beats, and an
+    index of the forms with each (number of bar types, number of bars), sorted by duration
+    """
+    forms = parse_file(source)
+    shapes = {}
+    for i, form in enumerate(forms):
+        shapes.setdefault((len(form.bar_types), len(form.bars)), []).append(i)
+    index = []
+    for (bar_types, bars), ids in sorted(shapes.items()):
+        ids.sort(key=lambda i: (forms[i].duration, i))
+        index.append([bar_types, bars, ids])
+    with open(filename, 'w') as f:
+        json.dump({
+            'forms': [form.form_string for form in forms],
+            'durations': [form.duration for form in forms],
+            'index': index
+        }, f, separators=(',', ':'))
+
+
+class Catalogue(object):
+    """
+    The forms from `build_catalogue`, as strings. Only the form that gets chosen is made into a
+    `Form`, and filtered draws bisect the index rather than looking at every form.
+    """
+    def __init__(self, filename=CATALOGUE):
+        with open(filename) as f:
+            data = json.load(f)
+        self.forms = [str(form_string) for form_string in data['forms']]
+        self.durations = data['durations']
+        # (number of bar types, number of bars): (durations, form indexes), both sorted by duration
+        self.index = {}
+        for bar_types, bars, ids in data['index']:
+            self.index[(bar_types, bars)] = ([self.durations[i] for i in ids], ids)
+
+    def __len__(self):
+        return len(self.forms)
+
+    def matching(self, min_duration=None, max_duration=None, bar_types=None, bars=None):
+        """The forms that fit, as a list of (form indexes sorted by duration, first, end) slices"""
+        slices = []
+        for (num_bar_types, num_bars), (durations, ids) in self.index.items():
+            if bar_types is not None and num_bar_types != bar_types:
+                continue
+            if bars is not None and num_bars != bars:
+                continue
+            first = 0 if min_duration is None else bisect_left(durations, min_duration)
+            end = len(ids) if max_duration is None else bisect_right(durations, max_duration)
+            if end > first:
+                slices.append((ids, first, end))
+        return slices
+
+    def choose(self, rng=random, **filters):
+        """
+        A form string, out of all of them or only those that fit `filters` (`min_duration` and
+        `max_duration` in beats, and exact numbers of `bar_types` and `bars`)
+        """
+        return self.forms[self.choose_index(rng, **filters)]
+
+    def choose_index(self, rng=random, **filters):
+        """Like `choose`, but the form's index, for looking up its duration too"""
+        if not filters:
+            return rng.choice(xrange(len(self.forms)))
+        slices = sorted(self.matching(**filters))
+        total = sum(end - first for _, first, end in slices)
+        if not total:
+            raise ValueError('No forms match {}'.format(filters))
+        n = int(rng.random() * total)
+        for ids, first, end in slices:
+            if n < end - first:
+                return ids[first + n]
+            n -= end - first
+
+
+_catalogue = None
+
+
+def get_catalogue():
+    global _catalogue
+    if _catalogue is None:
+        _catalogue = Catalogue()
+    return _catalogue
+
+
+def choose(rng=random, **filters):
+    """
+    A new `Form`, chosen at random, optionally only out of forms that fit `filters`
+    (see `Catalogue.choose`), e.g. `choose(max_duration=40)`
+    """
+    # A fresh one every time, since songs fill in the bar types of the form they get
+    return Form(get_catalogue().choose(rng, **filters))
 
 
 if __name__ == '__main__':
-    f = choose()
-    for b in f.bars:
-        print b.type_obj.harmonic_rhythm
\ No newline at end of file
+    if 'build' in sys.argv:
+        build_catalogue()
+    else:
+        f = choose()
+        for b in f.bars:
+            print b.type_obj.name, b.duration
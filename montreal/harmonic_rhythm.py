@@ -1,4 +1,6 @@
-from utils import weighted_choice
+import random
+
+from utils import WeightedSampler
 
 
 options_4 = [
@@ -352,10 +354,12 @@ weights_8 = [
     50     #      [3, 2.5, 2.5]
 ]
 
-def choose(dur):
-    if dur == 2:
-        return weighted_choice([[2], [1, 1]], [4, 1])
-    if dur == 4:
-        return weighted_choice(options_4, weights_4)
-    if dur == 8:
-        return weighted_choice(options_8, weights_8)
+samplers = {
+    2: WeightedSampler([[2], [1, 1]], [4, 1]),
+    4: WeightedSampler(options_4, weights_4),
+    8: WeightedSampler(options_8, weights_8)
+}
+
+
+def choose(dur, rng=random):
+    return samplers[dur].choose(rng)
@@ -1,6 +1,12 @@
+import random
+
 from utils import S
 
 
+# Some of the options below are rhythms drawn once while the tables are built. Drawing them
+# from a fixed seed keeps the tables the same in every process, so pieces can be reproduced.
+table_rng = random.Random(0)
+
 rhythm_options = {}
 rhythm_options[1] = S(
     (15, [1]),
@@ -13,7 +19,7 @@ rhythm_options[1] = S(
     (5, [.25, .25, .25, .25])
 )
 rhythm_options[2] = S(
-    (20, rhythm_options[1].choose() + rhythm_options[1].choose()),
+    (20, rhythm_options[1].choose(table_rng) + rhythm_options[1].choose(table_rng)),
     (3, [2]),
     (5, [.25, 1.75]),
     (15, [.5, 1.5]),
@@ -25,14 +31,14 @@ rhythm_options[2] = S(
     (5, [.5, .75, .75])
 )
 rhythm_options[4] = S(
-    (30, rhythm_options[2].choose() + rhythm_options[2].choose()),
+    (30, rhythm_options[2].choose(table_rng) + rhythm_options[2].choose(table_rng)),
     (6, [4]),
     (6, [.25, 3.75]),
     (6, [.5, 3.5]),
-    (20, rhythm_options[1].choose() + [3]),
+    (20, rhythm_options[1].choose(table_rng) + [3]),
     (3, [1.5, 2.5]),
     (3, [2.5, 1.5]),
-    (5, [3] + rhythm_options[1].choose()),
+    (5, [3] + rhythm_options[1].choose(table_rng)),
     (5, [3.5, .5]),
     (5, [3.75, .25]),
     (6, [.25, .25, 3.5]),
@@ -57,14 +63,14 @@ rhythm_options[4] = S(
     (7, [.75, .75, .75, .75, 1]),
 )
 rhythm_options[8] = S(
-    (50, rhythm_options[4].choose() + rhythm_options[4].choose()),
+    (50, rhythm_options[4].choose(table_rng) + rhythm_options[4].choose(table_rng)),
     (1, [8]),
-    (1, [7] + rhythm_options[1].choose()),
-    (1, rhythm_options[1].choose() + [7]),
-    (1, [6] + rhythm_options[2].choose()),
-    (1, rhythm_options[2].choose() + [6]),
+    (1, [7] + rhythm_options[1].choose(table_rng)),
+    (1, rhythm_options[1].choose(table_rng) + [7]),
+    (1, [6] + rhythm_options[2].choose(table_rng)),
+    (1, rhythm_options[2].choose(table_rng) + [6]),
 )
 
 
-def get_melody_rhythm(n):
-    return rhythm_options[n].choose()
+def get_melody_rhythm(n, rng=random):
+    return rhythm_options[n].choose(rng)
@@ -0,0 +1,171 @@
+"""
+Write a Standard MIDI File straight from the song/bar/note dicts, without music21.
+
+    piece = Piece(notation=False)
+    midi_writer.write_file(piece, 'montreal.mid')
+    midi_writer.write_songs(piece, 'songs/', processes=8)
+"""
+import os
+import struct
+from multiprocessing import Pool
+
+from utils import TICKS_PER_QUARTER
+
+
+# name: (channel, program), programs counted from 0
+PARTS = {
+    'vln': (0, 40),
+    'gtr': (1, 24)
+}
+
+VELOCITY = 80
+
+# Grace notes get this long, taken from the start of the note they lead into
+GRACE_TICKS = TICKS_PER_QUARTER // 8
+
+# Pitch bend for quarter tones, assuming the usual +/- 2 semitone bend range
+BEND_CENTER = 0x2000
+BEND_PER_SEMITONE = 0x1000
+
+
+def variable_length(n):
+    result = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        result.insert(0, (n & 0x7f) | 0x80)
+        n >>= 7
+    return result
+
+
+def meta(kind, data):
+    return bytearray([0xff, kind]) + variable_length(len(data)) + bytearray(data)
+
+
+def track(events):
+    """Encode (tick, order, message) events as an MTrk chunk. Lower `order` goes first at the same tick."""
+    data = bytearray()
+    now = 0
+    for tick, _, message in sorted(events, key=lambda e: (e[0], e[1])):
+        data += variable_length(tick - now)
+        data += message
+        now = tick
+    data += variable_length(0) + meta(0x2f, b'')
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+
+def bars_data(songs):
+    """
+    The parts of the songs that make it into the MIDI file, as plain tuples so they can be
+    handed to other processes: (ticks, beats, tempo, {instrument name: [(pitch, ticks), ...]})
+    """
+    bars = []
+    for song in songs:
+        for bar in song.bars:
+            parts = {}
+            for part in bar.parts:
+                parts[part['instrument_name']] = [(note['pitch'], note['duration']) for note in part['notes']]
+            bars.append((bar.ticks, bar.duration, bar.tempo, parts))
+    return bars
+
+
+def conductor_events(bars):
+    events = []
+    start = 0
+    previous_beats = None
+    for ticks, beats, tempo, _ in bars:
+        if beats != previous_beats:
+            events.append((start, 0, meta(0x58, bytearray([beats, 2, 24, 8]))))
+            previous_beats = beats
+        if tempo:
+            events.append((start, 0, meta(0x51, struct.pack('>I', 60000000 // tempo)[1:])))
+        start += ticks
+    return events
+
+
+def part_events(bars, name):
+    channel, program = PARTS[name]
+    events = [
+        (0, 0, meta(0x03, name.encode('ascii'))),
+        (0, 0, bytearray([0xc0 | channel, program]))
+    ]
+    bend = BEND_CENTER
+    start = 0
+    for ticks, _, _, parts in bars:
+        offset = start
+        graces = []
+        for pitch, duration in parts.get(name, []):
+            if pitch == 'rest':
+                offset += duration
+                continue
+            pitches = pitch if isinstance(pitch, list) else [pitch]
+            if duration == 0:
+                graces.append(pitches)
+                continue
+
+            # Play any grace notes at the start of this note and push the note itself back
+            grace_ticks = min(GRACE_TICKS, duration // (len(graces) + 1))
+            notes = [(grace, grace_ticks) for grace in graces]
+            notes.append((pitches, duration - grace_ticks * len(graces)))
+            graces = []
+
+            note_start = offset
+            for note_pitches, note_ticks in notes:
+                fraction = note_pitches[0] - int(note_pitches[0])
+                new_bend = BEND_CENTER + int(round(fraction * BEND_PER_SEMITONE))
+                if new_bend != bend:
+                    bend = new_bend
+                    events.append((note_start, 1, bytearray([0xe0 | channel, bend & 0x7f, bend >> 7])))
+                for p in note_pitches:
+                    key = int(p)
+                    events.append((note_start, 2, bytearray([0x90 | channel, key, VELOCITY])))
+                    events.append((note_start + note_ticks, 0, bytearray([0x80 | channel, key, 0])))
+                note_start += note_ticks
+            offset += duration
+        start += ticks
+    return events
+
+
+def encode(bars, names):
+    """A whole type 1 Standard MIDI File for `bars` (from `bars_data`) as a string of bytes"""
+    tracks = [track(conductor_events(bars))]
+    for name in names:
+        tracks.append(track(part_events(bars, name)))
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), TICKS_PER_QUARTER)
+    return header + b''.join(tracks)
+
+
+def write(piece, fh):
+    fh.write(encode(bars_data(piece.songs), piece.instruments.names))
+
+
+def write_file(piece, filename):
+    # Encoded before the file is opened, so a failure doesn't leave an empty file behind
+    data = encode(bars_data(piece.songs), piece.instruments.names)
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+
+
+def _write_song_file(args):
+    filename, bars, names = args
+    with open(filename, 'wb') as fh:
+        fh.write(encode(bars, names))
+    return filename
+
+
+def write_songs(piece, directory, processes=1):
+    """Write each song of `piece` to its own file in `directory`, optionally in parallel"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    jobs = []
+    for n, song in enumerate(piece.songs, 1):
+        filename = os.path.join(directory, 'song_{:03d}.mid'.format(n))
+        jobs.append((filename, bars_data([song]), piece.instruments.names))
+
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            return pool.map(_write_song_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [_write_song_file(job) for job in jobs]
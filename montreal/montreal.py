@@ -1,245 +1,470 @@
 #!/usr/bin/env python
 
 import sys
+import logging
 import datetime
 import random
+import operator
 from collections import defaultdict, Counter
 
-from music21.note import Note, Rest
-from music21.pitch import Pitch
-from music21.chord import Chord
-from music21.stream import Measure, Part, Score
-from music21.meter import TimeSignature
-from music21.metadata import Metadata
-from music21.instrument import Violin, AcousticGuitar
-from music21.layout import StaffGroup
-from music21.tempo import MetronomeMark
-from music21.duration import Duration
-
-from utils import weighted_choice
+from utils import WeightedSampler
 from utils import count_intervals
 from utils import frange
 from utils import fill
 from utils import divide
-from utils import split_at_beats
-from utils import join_quarters
 from utils import scale
 from utils import S
 from utils import get_simul
 from utils import set_start_end
-from utils import get_at
+from utils import Timeline
+from utils import to_ticks
+from utils import pitch_class_mask
+from utils import pitch_bits
+from utils import Event
 import harmonic_rhythm
+import midi_writer
 import form
+import planning
 from chord_types import get_harmony_generator
 from melody_rhythm import get_melody_rhythm
+from tracing import NULL_TRACER
+
+
+# Named rather than __name__ so it's the same logger when this file is run as a script
+log = logging.getLogger('montreal')
+
+
+ROOT_MOTION = WeightedSampler([
+    7,
+    5,
+    2,
+    10,
+    3,
+    8,
+    4,
+    9,
+    1,
+    11,
+    0,
+    6
+], range(24, 12, -1))
+
+
+class Instrument(object):
+    """An instrument's range as pitch numbers. The music21 instrument is only made in `notation`."""
+    def __init__(self, name, lowest_note, highest_note):
+        self.name = self.nickname = name
+        self.lowest_note = lowest_note
+        self.highest_note = highest_note
+        self.all_notes = list(frange(lowest_note, highest_note + 1))
+        self.all_notes_24 = list(frange(lowest_note, highest_note + 1, 0.5))
+        self.all_notes_bits = pitch_bits(self.all_notes)
 
 
 class Instruments(object):
     def __init__(self):
         self.names = ['vln', 'gtr']
-        self.vln = vln = Violin()
-        self.gtr = gtr = AcousticGuitar()
+        # lowest, highest notes
+        self.vln = vln = Instrument('vln', 55.0, 95.0)  # G3 to B6
+        self.gtr = gtr = Instrument('gtr', 40.0, 79.0)  # E2 to G5
         self.l = [vln, gtr]
         self.d = {}
         for name, inst in zip(self.names, self.l):
-            inst.nickname = name
             self.d[name] = inst
 
-        # lowest, highest notes
-        ranges = [
-            ('G3', 'B6'),  # Violin
-            ('E2', 'G5')  # Guitar
-        ]
-        for r, i in zip(ranges, self.l):
-            i.lowest_note = Pitch(r[0])
-            i.highest_note = Pitch(r[1])
-            i.all_notes = list(frange(i.lowest_note.ps, i.highest_note.ps + 1))
-            i.all_notes_24 = list(frange(i.lowest_note.ps, i.highest_note.ps + 1, 0.5))
-
-
-class Parts(object):
-    def __init__(self, instruments):
-        self.names = ['vln', 'gtr']
-        self.vln = vln = Part()
-        self.gtr = gtr = Part()
-        self.l = [vln, gtr]
-        self.d = {}
-        for name, part, inst in zip(self.names, self.l, instruments.l):
-            part.id = name
-            self.d[name] = part
-            part.insert(0, inst)
-
 
 class Piece(object):
-    def __init__(self, ranges=False):
-        score = self.score = Score()
-        self.instruments = self.i = Instruments()
-        self.parts = Parts(self.i)
+    title = 'Early Montreal'
+    composer = 'Jonathan Marmor'
 
+    def __init__(self, ranges=False, notation=True, seed=None, songs=None, tracer=NULL_TRACER):
+        """
+        With `notation=False` only the songs are made, not the music21 score. That's all the
+        native writers (like `musicxml_writer`) need.
+
+        Pass `songs` to make a piece out of songs that have already been made, for example to
+        write out a single song.
 
-        # Make Metadata
-        timestamp = datetime.datetime.utcnow()
-        metadata = Metadata()
-        metadata.title = 'Early Montreal'
-        metadata.composer = 'Jonathan Marmor'
-        metadata.date = timestamp.strftime('%Y/%m/%d')
-        score.insert(0, metadata)
+        Pass a `tracing.Tracer` as `tracer` to time each stage.
 
-        [score.insert(0, part) for part in self.parts.l]
-        score.insert(0, StaffGroup(self.parts.l))
+        The songs' forms and tempos are planned first to come as close as they can to the piece's
+        length (see `planning`). Every song gets its own seed drawn from `seed`, so the same
+        `seed` makes the same piece.
+
+        A piece is made in one process: its songs take less time to make than to send back from
+        worker processes. To use more cores, make several pieces at once with `batch.py --processes`.
+        """
+        if seed is None:
+            # Keep a seed either way, so any piece can be made again
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.tracer = tracer
+        self.instruments = self.i = Instruments()
+        self.timestamp = datetime.datetime.utcnow()
+        self.score = None
+        self.target_minutes = None
+        self.plan = None
+        # Each song's notation, as a list for each bar of (instrument name, measure)
+        self.measures = None
+        # (song index, bar type name or None for the whole song) changed since the notation was made
+        self.dirty = set()
+        # Pass to musicxml_writer as `cache` when regenerating, so writing again only renders the
+        # bars that changed
+        self.xml_cache = {}
 
         if ranges:
             # Don't make a piece, just show the instrument ranges
-            for inst, part in zip(self.instruments.l, self.parts.l):
-                measure = Measure()
-                measure.timeSignature = TimeSignature('4/4')
-                low = Note(inst.lowest_note)
-                measure.append(low)
-                high = Note(inst.highest_note)
-                measure.append(high)
-                part.append(measure)
+            self.songs = []
+            import notation
+            self.make_score()
+            notation.add_ranges(self.instruments, self.parts)
             return
 
+        with tracer.span('piece', piece_seed=seed):
+            if songs is None:
+                with tracer.span('songs'):
+                    songs = self.make_songs()
+            self.songs = songs
+
+            if notation:
+                with tracer.span('notation'):
+                    self.make_notation()
+
+    def make_score(self):
+        # music21 is slow to import, so only load it once there's notation to make
+        import notation
+        self.score, self.parts = notation.make_score(self)
+
+    def make_songs(self):
+        seeds = random.Random(self.seed)
 
         # 18 to 21 minutes
-        piece_duration_minutes = scale(random.random(), 0, 1, 18, 21)
+        self.target_minutes = scale(seeds.random(), 0, 1, 18, 21)
+
+        # Pick every song's form and tempo first, so only the songs that fit get made
+        with self.tracer.span('plan'):
+            self.plan = planning.plan(seeds, self.target_minutes)
 
         # Make the "songs"
         songs = []
-        total_minutes = 0
-        n = 1
-        while total_minutes < piece_duration_minutes:
-            print 'Song {}'.format(n)
-            n += 1
-            song = Song(self)
-            songs.append(song)
-            total_minutes += song.duration_minutes
-
-        # Make notation
+        for n, (form_string, tempo, seed) in enumerate(self.plan, 1):
+            log.info('Song %d', n)
+            songs.append(Song(self.instruments, seed=seed, tracer=self.tracer,
+                              form_string=form_string, tempo=tempo))
+        return songs
+
+    def make_notation(self):
+        import notation
+        self.make_score()
+
+        notated = []
         previous_duration = None
-        for song in songs:
-            for bar in song.bars:
-                for part in bar.parts:
-                    measure = Measure()
-                    if bar.tempo:
-                        measure.insert(0, MetronomeMark(number=bar.tempo, referent=Duration(1)))
-                        measure.leftBarline = 'double'
-                    if bar.duration != previous_duration:
-                        ts = TimeSignature('{}/4'.format(bar.duration))
-                        measure.timeSignature = ts
-
-                    # Fix Durations
-                    durations = [note['duration'] for note in part['notes']]
-
-                    components_list = split_at_beats(durations)
-                    components_list = [join_quarters(note_components) for note_components in components_list]
-                    for note, components in zip(part['notes'], components_list):
-                        note['durations'] = components
-
-
-                    for note in part['notes']:
-                        if note['pitch'] == 'rest':
-                            n = Rest()
-                        if isinstance(note['pitch'], list):
-                            pitches = []
-                            for pitch_number in note['pitch']:
-                                p = Pitch(pitch_number)
-                                # Force all flats
-                                if p.accidental.name == 'sharp':
-                                    p = p.getEnharmonic()
-                                pitches.append(p)
-                            n = Chord(notes=pitches)
-
-                            # TODO add slurs
-                            # TODO add glissandos
-                            # TODO add -50 cent marks
-
-
-                        else:
-                            p = Pitch(note['pitch'])
-                            # Force all flats
-                            if p.accidental.name == 'sharp':
-                                p = p.getEnharmonic()
-                            n = Note(p)
-
-                            # TODO add slurs
-                            # TODO add glissandos
-                            # TODO add -50 cent marks
-
-                        d = Duration()
-                        if note['duration'] == 0:
-                            d.quarterLength = .5
-                            d = d.getGraceDuration()
-                        else:
-                            d.fill(note['durations'])
-                        n.duration = d
-
-                        measure.append(n)
-
-                    self.parts.d[part['instrument_name']].append(measure)
+        for song in self.songs:
+            with self.tracer.span('notate_song', seed=song.seed):
+                notated.append(notation.notate_song(song, previous_duration))
+            previous_duration = song.bars[-1].duration
+
+        self.measures = notated
+        self.dirty = set()
+        for song_measures in notated:
+            for measures in song_measures:
+                for instrument_name, measure in measures:
+                    self.parts.d[instrument_name].append(measure)
+
+    def regenerate_song(self, index, seed=None):
+        """
+        Make song `index` again with a new `seed` (random unless given), keeping its form and
+        tempo so the piece stays the same length. Returns the seed.
+        """
+        if seed is None:
+            seed = random.getrandbits(32)
+        old = self.songs[index]
+        self.songs[index] = Song(self.instruments, seed=seed, tracer=self.tracer,
+                                 form_string=old.form.form_string, tempo=old.tempo)
+        self.dirty.add((index, None))
+        return seed
+
+    def regenerate_bar_type(self, index, name, stage='melody', seed=None):
+        """
+        Make bar type `name` of song `index` again from `stage` on. See `Song.regenerate_bar_type`.
+        """
+        seed = self.songs[index].regenerate_bar_type(name, stage, seed)
+        self.dirty.add((index, name))
+        return seed
+
+    def update_notation(self):
+        """
+        Notate only the bars that changed since the notation was made and swap them into the
+        score. Returns the number of bars notated.
+        """
+        if self.score is None:
+            self.dirty = set()
+            return 0
+        import notation
+
+        dirty = defaultdict(set)
+        for index, name in self.dirty:
+            dirty[index].add(name)
+
+        count = 0
+        for index in sorted(dirty):
+            song = self.songs[index]
+            names = dirty[index]
+            previous_duration = self.songs[index - 1].bars[-1].duration if index else None
+            specs = {}
+            for i, bar in enumerate(song.bars):
+                if None in names or bar.type in names:
+                    with self.tracer.span('notate_bar', seed=song.seed, bar_type=bar.type):
+                        measures = notation.notate_bar(bar, previous_duration, specs)
+                    for (instrument_name, old), (_, new) in zip(self.measures[index][i], measures):
+                        self.parts.d[instrument_name].replace(old, new)
+                    self.measures[index][i] = measures
+                    count += 1
                 previous_duration = bar.duration
+        self.dirty = set()
+        return count
+
+
+# What goes into a bar type, in order. Each one depends on the ones before it.
+STAGES = ['harmonic_rhythm', 'harmony', 'melody']
+
+STEPS = (-2, -1, 1, 2)
+LEAPS = (-5, -4, -3, 3, 4, 5)
+
+_pitch_options_cache = {}
+
+
+def _allowed(prev, intervals, harmony_mask, range_bits):
+    options = []
+    for interval in intervals:
+        p = prev + interval
+        n = int(p)
+        if harmony_mask >> n % 12 & 1 and n >= 0 and range_bits >> n & 1:
+            options.append(p)
+    return tuple(options)
+
+
+def pitch_options(prev, harmony_mask, range_bits):
+    """
+    The melody's candidate pitches after `prev`, as (steps, whether `prev` is in the harmony, leaps),
+    keeping only pitches in `harmony_mask` (a 12-bit pitch class mask) and `range_bits` (an
+    instrument's `all_notes_bits`). Worked out once per combination and then looked up.
+    """
+    key = (prev, harmony_mask, range_bits)
+    options = _pitch_options_cache.get(key)
+    if options is None:
+        options = _pitch_options_cache[key] = (
+            _allowed(prev, STEPS, harmony_mask, range_bits),
+            bool(harmony_mask >> int(prev) % 12 & 1),
+            _allowed(prev, LEAPS, harmony_mask, range_bits)
+        )
+    return options
+
+
+# Grace notes before a melody note, as offsets in semitones from it, depending on whether the melody
+# went up or down to the note. Shapes that appear more than once are that much more likely.
+ORNAMENT_SHAPES = {
+    'ascending': (
+        (-1,),
+        (-2,),
+        (-1,),
+        (-2,),
+        (-1,),
+        (-2,),
+        (-1,),
+        (-2,),
+        (-2, -1),
+        (-3, -1),
+        (-3, -2),
+        (-4, -2),
+        (0, -1),
+        (0, -2),
+        (-1, -2),
+        (-1, -3),
+        (-2, -3),
+        (-2, -4),
+
+        (-1, 1),
+        (-1, 2),
+        (-2, 1),
+        (-2, 2),
+        (1, -1),
+        (1, -2),
+        (2, -1),
+        (2, -2)
+    ),
+    'descending': (
+        (1,),
+        (2,),
+        (1,),
+        (2,),
+        (1,),
+        (2,),
+        (1,),
+        (2,),
+        (2, 1),
+        (3, 1),
+        (3, 2),
+        (4, 2),
+        (0, 1),
+        (0, 2),
+        (1, 2),
+        (1, 3),
+        (2, 3),
+        (2, 4),
+
+        (-1, 1),
+        (-1, 2),
+        (-2, 1),
+        (-2, 2),
+        (1, -1),
+        (1, -2),
+        (2, -1),
+        (2, -2)
+    )
+}
+
+_ornament_samplers = {}
+
+
+def ornament_sampler(direction, pitch_class, harmony_mask):
+    """
+    A sampler over the ornament shapes whose grace notes all fit `harmony_mask` when the note has
+    `pitch_class`, weighted by how often each shape appears. None if no shape fits.
+    """
+    key = (direction, pitch_class, harmony_mask)
+    if key not in _ornament_samplers:
+        weights = Counter(shape for shape in ORNAMENT_SHAPES[direction]
+                          if all(harmony_mask >> (pitch_class + offset) % 12 & 1 for offset in shape))
+        shapes = sorted(weights)
+        _ornament_samplers[key] = WeightedSampler(shapes, [weights[shape] for shape in shapes]) if shapes else None
+    return _ornament_samplers[key]
 
 
 class Song(object):
-    def __init__(self, piece):
+    # Only use ornaments made of pitches in the harmony under the note, when any fit
+    ornaments_respect_harmonies = False
+
+    def __init__(self, instruments, seed=None, tracer=NULL_TRACER, ornaments_respect_harmonies=None,
+                 form_string=None, tempo=None):
         """
+        `form_string` and `tempo` are chosen at random unless they're given (see `planning`)
+
         self.duration = total song duration
         self.bars =
             bar.parts =
                 part['instrument_name']
                 part['notes']
                     note['pitch']
-                    note['duration'] = total note duration
+                    note['duration'] = total note duration in ticks
 
 
         """
-        self.piece = piece
-        self.prev_root = random.randint(0, 11)
-        self.harmony_generator = get_harmony_generator()
-        # TODO choose roots
-
-        self.vln_all_notes = self.piece.instruments.vln.all_notes
-        self.vln_register = self.choose_violin_register()
-
-        self.form = form.choose()
-        self.bars = self.form.bars
-
-        self.duration_beats = self.form.duration
-        self.tempo = random.randint(55, 80)
-        self.bars[0].tempo = self.tempo
-        self.duration_minutes = self.duration_beats / float(self.tempo)
-
-        for name in self.form.bar_types:
-            bar_type = self.form.bar_types[name]
-            bar_type.harmonic_rhythm = harmonic_rhythm.choose(bar_type.duration)
-
-            bar_type.parts[1]['notes']= [{
-                'duration': harm_dur,
-                'pitch': self.choose_harmony()
-            } for harm_dur in bar_type.harmonic_rhythm]
-
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.instruments = instruments
+        self.tracer = tracer
+        if ornaments_respect_harmonies is not None:
+            self.ornaments_respect_harmonies = ornaments_respect_harmonies
+
+        with tracer.span('song', seed=seed) as span:
+            self.prev_root = self.rng.randint(0, 11)
+            self.harmony_generator = get_harmony_generator(self.rng)
+            # TODO choose roots
+
+            self.vln_all_notes = self.instruments.vln.all_notes
+            self.vln_all_notes_bits = self.instruments.vln.all_notes_bits
+            self.vln_register = self.choose_violin_register()
+
+            with tracer.span('form') as form_span:
+                if form_string is None:
+                    self.form = form.choose(self.rng)
+                else:
+                    self.form = form.Form(form_string)
+                self.tempo = planning.choose_tempo(self.rng) if tempo is None else tempo
+                # Tag the form stage as well as the song, since it started before they were known
+                form_span.tag(form=self.form.form_string, tempo=self.tempo)
+                span.tag(form=self.form.form_string, tempo=self.tempo)
+            self.bars = self.form.bars
+
+            self.duration_beats = self.form.duration
+            self.bars[0].tempo = self.tempo
+            self.duration_minutes = self.duration_beats / float(self.tempo)
+
+            for name in self.form.bar_types:
+                self.make_bar_type(self.form.bar_types[name])
+
+            for bar in self.bars:
+                bar.parts = bar.type_obj.parts
+
+    def make_bar_type(self, bar_type, stage='harmonic_rhythm'):
+        """
+        Make the music of `bar_type` from `stage` (one of `STAGES`) on, since each stage is built
+        on the one before. The parts get new lists of notes rather than changing the old ones.
+        """
+        stages = STAGES[STAGES.index(stage):]
+        name = bar_type.name
+        if 'harmonic_rhythm' in stages:
+            with self.tracer.span('harmonic_rhythm', bar_type=name):
+                bar_type.harmonic_rhythm = harmonic_rhythm.choose(bar_type.duration, self.rng)
+
+        if 'harmony' in stages:
+            with self.tracer.span('harmony', bar_type=name):
+                bar_type.parts[1]['notes'] = [
+                    Event(duration=to_ticks(harm_dur), pitch=self.choose_harmony())
+                    for harm_dur in bar_type.harmonic_rhythm]
+
+        with self.tracer.span('melody', bar_type=name):
             bar_type.parts[0]['notes'] = self.choose_melody_notes(bar_type.duration, bar_type.parts[1]['notes'])
 
-        for bar in self.bars:
-            bar.parts = bar.type_obj.parts
+    def regenerate_bar_type(self, name, stage='melody', seed=None):
+        """
+        Make bar type `name` again from `stage` on ('harmonic_rhythm', 'harmony' or 'melody'),
+        keeping everything else, with a new `seed` (random unless given). Returns the seed.
+        """
+        if stage not in STAGES:
+            raise ValueError('stage must be one of {}'.format(', '.join(STAGES)))
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.rng = random.Random(seed)
+        # Chords come from their own generator, so it has to start again from the new seed too
+        self.harmony_generator = get_harmony_generator(self.rng)
+        with self.tracer.span('regenerate', seed=self.seed, bar_type=name, stage=stage):
+            self.make_bar_type(self.form.bar_types[name], stage)
+        return seed
+
+    def to_dict(self):
+        """Everything about the song that ends up in the music, as plain data (for JSON)"""
+        return {
+            'seed': self.seed,
+            'form': self.form.form_string,
+            'tempo': self.tempo,
+            'duration_beats': self.duration_beats,
+            'duration_minutes': self.duration_minutes,
+            'bars': [{
+                'type': bar.type,
+                'duration': bar.duration,
+                'tempo': bar.tempo,
+                'parts': dict((part['instrument_name'], [{
+                    'pitch': note['pitch'],
+                    'duration': note['duration']
+                } for note in part['notes']]) for part in bar.parts)
+            } for bar in self.bars]
+        }
+
+    def __getstate__(self):
+        # For pickling songs. Generators can't be pickled, the instruments are the same
+        # everywhere, and the tracer has the spans of the whole piece.
+        state = self.__dict__.copy()
+        state['harmony_generator'] = None
+        state['instruments'] = None
+        state['tracer'] = NULL_TRACER
+        return state
 
     def choose_root(self):
-        return random.randint(0, 11)
-
-        root_motion = weighted_choice([
-            7,
-            5,
-            2,
-            10,
-            3,
-            8,
-            4,
-            9,
-            1,
-            11,
-            0,
-            6
-        ], range(24, 12, -1))
+        return self.rng.randint(0, 11)
+
+        root_motion = ROOT_MOTION.choose(self.rng)
         root = (self.prev_root + root_motion) % 12
         self.prev_root = root
         return root
@@ -253,8 +478,8 @@ class Song(object):
         return [p + root + 48 for p in chord_type]
 
     def choose_violin_register(self):
-        lowest = random.randint(0, 18)
-        width = random.randint(13, 22)
+        lowest = self.rng.randint(0, 18)
+        width = self.rng.randint(13, 22)
         highest = lowest + width
         return self.vln_all_notes[lowest:highest]
 
@@ -268,59 +493,56 @@ class Song(object):
         # for p in register:
         #     register_by_pitch_classes[p % 12].append(p)
 
-        rhythm = get_melody_rhythm(duration)
+        with self.tracer.span('melody_rhythm'):
+            rhythm = get_melody_rhythm(duration, self.rng)
 
-        for r in rhythm:
-            notes.append({
-                'pitch': None,
-                'duration': r
-            })
+            for r in rhythm:
+                notes.append(Event(duration=to_ticks(r)))
 
-        self.choose_melody_pitches(notes, self.vln_register, harmonies)
+        with self.tracer.span('melody_pitches'):
+            self.choose_melody_pitches(notes, self.vln_register, harmonies)
 
-        notes = self.add_ornaments(notes)
+        with self.tracer.span('ornaments'):
+            notes = self.add_ornaments(notes)
 
         return notes
 
 
-    def get_pitch_options(self, note_harmonies, prev):
-        pitch_options = [prev - 2, prev - 1, prev + 1, prev + 2]
-        pitch_options = [p for p in pitch_options if p % 12 in note_harmonies and p in self.vln_all_notes]
-        if len(pitch_options) == 0:
-            if prev % 12 in note_harmonies and random.random() < .12:
-                pitch_options = [prev]
-            else:
-                pitch_options = [prev - 5, prev - 4, prev - 3, prev + 3, prev + 4, prev + 5]
-                pitch_options = [p for p in pitch_options if p % 12 in note_harmonies and p in self.vln_all_notes]
-            # if len(pitch_options) == 0:
-            #     pitch_options = [prev - 8, prev - 7, prev - 6, prev + 6, prev + 7, prev + 8]
-            #     pitch_options = [p for p in pitch_options if p % 12 in note_harmonies]
-        return pitch_options
+    def get_pitch_options(self, harmony_mask, prev):
+        """`harmony_mask` is a `pitch_class_mask` of the pitch classes the melody can use"""
+        steps, prev_in_harmony, leaps = pitch_options(prev, harmony_mask, self.vln_all_notes_bits)
+        if steps:
+            return steps
+        if prev_in_harmony and self.rng.random() < .12:
+            return (prev,)
+        return leaps
 
     def choose_melody_pitches(self, notes, register, harmonies):
-        print 'Choosing pitches'
+        # Checked once, so the per-note trace costs nothing unless debug logging is on
+        debug = log.isEnabledFor(logging.DEBUG)
         for h in harmonies:
             h['pitch_classes'] = [p % 12 for p in h['pitch']]
+            h['pitch_class_mask'] = pitch_class_mask(h['pitch'])
 
         set_start_end(notes)
         set_start_end(harmonies)
 
-        previous_note_index = random.choice(range(int(len(register) * .4)))
+        previous_note_index = self.rng.choice(range(int(len(register) * .4)))
         prev = register[previous_note_index]
 
+        harmony_timeline = Timeline(harmonies)
+
         for note in notes:
-            beats = list(frange(note['start'], note['start'] + note['duration'], .25))
             note_harmonies = []
-            for b in beats:
-                h = get_at(b, harmonies)
-                h = h['pitch_classes']
-                if h not in note_harmonies:
-                    note_harmonies.append(h)
+            masks = []
+            for h in harmony_timeline.overlapping(note['start'], note['end']):
+                if h['pitch_classes'] not in note_harmonies:
+                    note_harmonies.append(h['pitch_classes'])
+                    masks.append(h['pitch_class_mask'])
 
-            print 'note_harmonies', note_harmonies
 
             if len(note_harmonies) == 1:
-                pitch_options = self.get_pitch_options(note_harmonies[0], prev)
+                pitch_options = self.get_pitch_options(masks[0], prev)
             else:
                 pitch_options = []
 
@@ -335,116 +557,61 @@ class Song(object):
                         common.append(p)
 
                 if len(common) > 0:
-                    pitch_options = self.get_pitch_options(common, prev)
+                    pitch_options = self.get_pitch_options(pitch_class_mask(common), prev)
 
                 if len(pitch_options) == 0:
                     ranked = [p for p, _ in c.most_common() if p not in common]
 
                     for p in ranked:
-                        pitch_options = self.get_pitch_options([p], prev)
+                        pitch_options = self.get_pitch_options(1 << p, prev)
                         if len(pitch_options) > 0:
                             break
 
             if len(pitch_options) == 0:
                 pitch_options = [prev - 2, prev - 1, prev + 1, prev + 2]
 
-            note['pitch'] = random.choice(pitch_options)
-
-            print note['pitch'] % 12
-            print
+            note['pitch'] = self.rng.choice(pitch_options)
+
+            if debug:
+                log.debug('melody note at %s: harmonies %s, options %s, chose %s', note['start'],
+                          note_harmonies, pitch_options, note['pitch'], extra={'melody_note': {
+                              'song_seed': self.seed,
+                              'start': note['start'],
+                              'end': note['end'],
+                              'previous': prev,
+                              'harmonies': note_harmonies,
+                              'pitch_options': pitch_options,
+                              'pitch': note['pitch'],
+                              'pitch_class': note['pitch'] % 12
+                          }})
 
             prev = note['pitch']
 
-            self.add_ornament(note, prev, note_harmonies)
+            self.add_ornament(note, prev, reduce(operator.or_, masks, 0))
 
-    def add_ornament(self, note, prev, harmonies):
-        if note['duration'] < .75 or random.random() < .3:
+    def add_ornament(self, note, prev, harmony_mask):
+        if note['duration'] < to_ticks(.75) or self.rng.random() < .3:
             return
 
-        harmonies = [p for p in [h for h in harmonies]]
-
         interval = note['pitch'] - prev
         if interval > 0:
             direction = 'ascending'
         if interval < 0:
             direction = 'descending'
         if interval == 0:
-            direction = random.choice(['ascending', 'descending'])
+            direction = self.rng.choice(['ascending', 'descending'])
 
         np = int(note['pitch'])
 
-        # below = [p for p in range(np - 4,  np) if p % 12 in harmonies]
-        # above = [p for p in range(np + 1,  np + 5) if p % 12 in harmonies]
-
-        orn_types = {}
-        orn_types['ascending'] = [
-            [np - 1],
-            [np - 2],
-            [np - 1],
-            [np - 2],
-            [np - 1],
-            [np - 2],
-            [np - 1],
-            [np - 2],
-            [np - 2, np - 1],
-            [np - 3, np - 1],
-            [np - 3, np - 2],
-            [np - 4, np - 2],
-            [np, np - 1],
-            [np, np - 2],
-            [np - 1, np - 2],
-            [np - 1, np - 3],
-            [np - 2, np - 3],
-            [np - 2, np - 4],
-
-            [np - 1, np + 1],
-            [np - 1, np + 2],
-            [np - 2, np + 1],
-            [np - 2, np + 2],
-            [np + 1, np - 1],
-            [np + 1, np - 2],
-            [np + 2, np - 1],
-            [np + 2, np - 2]
-        ]
-        orn_types['descending'] = [
-            [np + 1],
-            [np + 2],
-            [np + 1],
-            [np + 2],
-            [np + 1],
-            [np + 2],
-            [np + 1],
-            [np + 2],
-            [np + 2, np + 1],
-            [np + 3, np + 1],
-            [np + 3, np + 2],
-            [np + 4, np + 2],
-            [np, np + 1],
-            [np, np + 2],
-            [np + 1, np + 2],
-            [np + 1, np + 3],
-            [np + 2, np + 3],
-            [np + 2, np + 4],
-
-            [np - 1, np + 1],
-            [np - 1, np + 2],
-            [np - 2, np + 1],
-            [np - 2, np + 2],
-            [np + 1, np - 1],
-            [np + 1, np - 2],
-            [np + 2, np - 1],
-            [np + 2, np - 2]
-        ]
-
-        orn_type = random.choice(orn_types[direction])
-
-
-        note['ornaments'] = []
-        for n in orn_type:
-            note['ornaments'].append({
-                'pitch': n,
-                'duration': 0
-            })
+        sampler = None
+        if self.ornaments_respect_harmonies:
+            sampler = ornament_sampler(direction, np % 12, harmony_mask)
+        if sampler:
+            shape = sampler.choose(self.rng)
+        else:
+            shape = self.rng.choice(ORNAMENT_SHAPES[direction])
+
+        note['ornaments'] = [Event(pitch=np + offset) for offset in shape]
 
     def add_ornaments(self, notes):
         new_notes = []
@@ -459,7 +626,10 @@ class Song(object):
 
 
 if __name__ == '__main__':
-    print 'STARTING!!!', '*' * 40
+    # `verbose` logs every melody note decision, otherwise just each song
+    logging.basicConfig(level=logging.DEBUG if 'verbose' in sys.argv else logging.INFO,
+                        format='%(message)s')
+    log.info('STARTING!!! %s', '*' * 40)
     show = True
     if 'ranges' in sys.argv:
         piece = Piece(ranges=True)
@@ -467,7 +637,11 @@ if __name__ == '__main__':
         piece = Piece()
 
     if 'midi' in sys.argv:
-        piece.score.show('midi')
+        if 'ranges' in sys.argv:
+            # The ranges are only in the score, there are no songs to write
+            piece.score.write('midi', 'montreal.mid')
+        else:
+            midi_writer.write_file(piece, 'montreal.mid')
 
     if 'noshow' not in sys.argv:
         if 'muse' in sys.argv:
@@ -0,0 +1,208 @@
+"""
+Write a piece to MusicXML straight from the song/bar/note dicts, one measure at a time,
+without building a music21 score first.
+
+    piece = Piece(notation=False)
+    musicxml_writer.write_file(piece, 'montreal.xml')
+"""
+from xml.sax.saxutils import escape
+
+from utils import TICKS_PER_QUARTER, split_durations
+from spelling import xml_pitch
+
+
+PARTS = {
+    'vln': ('Violin', 'Vln', 41),
+    'gtr': ('Acoustic Guitar', 'Ac Gtr', 25)
+}
+
+# Longest first, for breaking a tied component into notes that can be written
+NOTE_TYPES = [
+    (TICKS_PER_QUARTER * 8, 'breve', 0),
+    (TICKS_PER_QUARTER * 7, 'whole', 2),
+    (TICKS_PER_QUARTER * 6, 'whole', 1),
+    (TICKS_PER_QUARTER * 4, 'whole', 0),
+    (TICKS_PER_QUARTER * 3, 'half', 1),
+    (TICKS_PER_QUARTER * 2, 'half', 0),
+    (TICKS_PER_QUARTER * 3 // 2, 'quarter', 1),
+    (TICKS_PER_QUARTER, 'quarter', 0),
+    (TICKS_PER_QUARTER * 3 // 4, 'eighth', 1),
+    (TICKS_PER_QUARTER // 2, 'eighth', 0),
+    (TICKS_PER_QUARTER * 3 // 8, '16th', 1),
+    (TICKS_PER_QUARTER // 4, '16th', 0),
+    (TICKS_PER_QUARTER // 8, '32nd', 0)
+]
+
+
+def note_types(ticks):
+    """Break a duration into (ticks, type, dots) that can each be written as a single note"""
+    result = []
+    for type_ticks, name, dots in NOTE_TYPES:
+        while ticks >= type_ticks:
+            result.append((type_ticks, name, dots))
+            ticks -= type_ticks
+    return result
+
+
+def format_alter(alter):
+    if alter == int(alter):
+        return str(int(alter))
+    return str(alter)
+
+
+def note_xml(pitches, ticks, name, dots, tie_start=False, tie_stop=False, grace=False):
+    """The <note> elements for one written note, or a chord if there are several pitches"""
+    lines = []
+    for i, pitch in enumerate(pitches):
+        lines.append('<note>')
+        if grace:
+            lines.append('<grace slash="yes"/>')
+        if i > 0:
+            lines.append('<chord/>')
+        if pitch is None:
+            lines.append('<rest/>')
+        else:
+            step, alter, octave = xml_pitch(pitch)
+            lines.append('<pitch><step>{}</step><alter>{}</alter><octave>{}</octave></pitch>'.format(
+                step, format_alter(alter), octave))
+        if not grace:
+            lines.append('<duration>{}</duration>'.format(ticks))
+        if tie_stop:
+            lines.append('<tie type="stop"/>')
+        if tie_start:
+            lines.append('<tie type="start"/>')
+        lines.append('<type>{}</type>'.format(name))
+        lines.extend(['<dot/>'] * dots)
+        if pitch is not None and (tie_start or tie_stop):
+            lines.append('<notations>')
+            if tie_stop:
+                lines.append('<tied type="stop"/>')
+            if tie_start:
+                lines.append('<tied type="start"/>')
+            lines.append('</notations>')
+        lines.append('</note>')
+    return '\n'.join(lines)
+
+
+def notes_xml(notes):
+    """The <note> elements for a bar's worth of notes"""
+    lines = []
+    components_list = split_durations([note['duration'] for note in notes])
+    for note, components in zip(notes, components_list):
+        pitches = note['pitch']
+        if pitches == 'rest':
+            pitches = [None]
+        elif not isinstance(pitches, list):
+            pitches = [pitches]
+
+        if note['duration'] == 0:
+            lines.append(note_xml(pitches, 0, 'eighth', 0, grace=True))
+            continue
+
+        written = [t for component in components for t in note_types(component)]
+        last = len(written) - 1
+        tied = pitches != [None]
+        for i, (ticks, name, dots) in enumerate(written):
+            lines.append(note_xml(pitches, ticks, name, dots,
+                                  tie_start=tied and i < last, tie_stop=tied and i > 0))
+    return '\n'.join(lines)
+
+
+def measure_xml(number, bar, notes, time_signature, first):
+    """A <measure>, where `notes` is the `notes_xml` for the bar"""
+    lines = ['<measure number="{}">'.format(number)]
+    if first or time_signature:
+        lines.append('<attributes>')
+        if first:
+            lines.append('<divisions>{}</divisions>'.format(TICKS_PER_QUARTER))
+        if time_signature:
+            lines.append('<time><beats>{}</beats><beat-type>4</beat-type></time>'.format(bar.duration))
+        lines.append('</attributes>')
+    if bar.tempo:
+        lines.append('<barline location="left"><bar-style>light-light</bar-style></barline>')
+        lines.append('<direction><direction-type><metronome parentheses="no">'
+                     '<beat-unit>quarter</beat-unit><per-minute>{0}</per-minute>'
+                     '</metronome></direction-type><sound tempo="{0}"/></direction>'.format(bar.tempo))
+    lines.append(notes)
+    lines.append('</measure>')
+    return '\n'.join(lines)
+
+
+def header_xml(piece):
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.0 Partwise//EN" '
+        '"http://www.musicxml.org/dtds/partwise.dtd">',
+        '<score-partwise version="3.0">',
+        '<work><work-title>{}</work-title></work>'.format(escape(piece.title)),
+        '<movement-title>{}</movement-title>'.format(escape(piece.title)),
+        '<identification>',
+        '<creator type="composer">{}</creator>'.format(escape(piece.composer)),
+        '<encoding><encoding-date>{}</encoding-date></encoding>'.format(piece.timestamp.strftime('%Y-%m-%d')),
+        '<miscellaneous><miscellaneous-field name="date">{}</miscellaneous-field></miscellaneous>'.format(
+            piece.timestamp.strftime('%Y/%m/%d')),
+        '</identification>',
+        '<part-list>',
+        '<part-group number="1" type="start"><group-barline>yes</group-barline></part-group>'
+    ]
+    for channel, name in enumerate(piece.instruments.names, 1):
+        part_name, abbreviation, program = PARTS[name]
+        lines.extend([
+            '<score-part id="{}">'.format(name),
+            '<part-name>{}</part-name>'.format(part_name),
+            '<part-abbreviation>{}</part-abbreviation>'.format(abbreviation),
+            '<score-instrument id="{}-I"><instrument-name>{}</instrument-name></score-instrument>'.format(
+                name, part_name),
+            '<midi-instrument id="{}-I"><midi-channel>{}</midi-channel><midi-program>{}</midi-program>'
+            '</midi-instrument>'.format(name, channel, program),
+            '</score-part>'
+        ])
+    lines.extend([
+        '<part-group number="1" type="stop"/>',
+        '</part-list>'
+    ])
+    return '\n'.join(lines)
+
+
+def write(piece, fh, cache=None):
+    """
+    Stream `piece` to the open file `fh` as MusicXML, one measure at a time. The bars of a bar type
+    share one list of notes, so their XML is only made once.
+
+    Pass a dict as `cache` (like the piece's `xml_cache`) to keep that XML between writes.
+    Regenerating music gives it new lists of notes, so writing again only renders the bars that
+    changed. Without one, nothing is kept once the piece is written.
+    """
+    if cache is None:
+        cache = {}
+    used = {}
+    fh.write(header_xml(piece))
+    fh.write('\n')
+    for name in piece.instruments.names:
+        fh.write('<part id="{}">\n'.format(name))
+        number = 1
+        previous_duration = None
+        for song in piece.songs:
+            for bar in song.bars:
+                part = [p for p in bar.parts if p['instrument_name'] == name][0]
+                notes = part['notes']
+                key = id(notes)
+                if key not in used:
+                    # Keep the notes too, so the id can't be reused while they're cached
+                    used[key] = cache.get(key) or (notes, notes_xml(notes))
+                time_signature = bar.duration != previous_duration
+                fh.write(measure_xml(number, bar, used[key][1], time_signature, number == 1))
+                fh.write('\n')
+                previous_duration = bar.duration
+                number += 1
+        fh.write('</part>\n')
+    fh.write('</score-partwise>\n')
+
+    # Forget the bars that aren't in the piece any more
+    cache.clear()
+    cache.update(used)
+
+
+def write_file(piece, filename, cache=None):
+    with open(filename, 'w') as fh:
+        write(piece, fh, cache)
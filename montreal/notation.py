@@ -0,0 +1,171 @@
+"""
+The music21 side of a piece: the score, parts and measures made from the songs. music21 takes a
+long time to import, so nothing imports this until there is notation to make.
+"""
+from music21.note import Note, Rest
+from music21.pitch import Pitch
+from music21.chord import Chord
+from music21.stream import Measure, Part, Score
+from music21.meter import TimeSignature
+from music21.metadata import Metadata
+from music21.instrument import Violin, AcousticGuitar
+from music21.layout import StaffGroup
+from music21.tempo import MetronomeMark
+from music21.duration import Duration
+
+from utils import split_durations
+from utils import to_quarters
+import spelling
+
+
+INSTRUMENTS = {
+    'vln': Violin,
+    'gtr': AcousticGuitar
+}
+
+
+class Parts(object):
+    def __init__(self, instruments):
+        self.names = ['vln', 'gtr']
+        self.vln = vln = Part()
+        self.gtr = gtr = Part()
+        self.l = [vln, gtr]
+        self.d = {}
+        for name, part in zip(self.names, self.l):
+            inst = INSTRUMENTS[name]()
+            inst.nickname = name
+            part.id = name
+            self.d[name] = part
+            part.insert(0, inst)
+
+
+def make_score(piece):
+    """An empty score for `piece`, with its metadata and parts. Returns (score, parts)."""
+    score = Score()
+    parts = Parts(piece.instruments)
+
+    # Make Metadata
+    metadata = Metadata()
+    metadata.title = piece.title
+    metadata.composer = piece.composer
+    metadata.date = piece.timestamp.strftime('%Y/%m/%d')
+    score.insert(0, metadata)
+
+    [score.insert(0, part) for part in parts.l]
+    score.insert(0, StaffGroup(parts.l))
+    return score, parts
+
+
+def add_ranges(instruments, parts):
+    """A measure in each part with the lowest and highest notes of the instrument"""
+    for inst, part in zip(instruments.l, parts.l):
+        measure = Measure()
+        measure.timeSignature = TimeSignature('4/4')
+        low = Note(Pitch(inst.lowest_note))
+        measure.append(low)
+        high = Note(Pitch(inst.highest_note))
+        measure.append(high)
+        part.append(measure)
+
+
+_duration_components = {}
+
+
+def duration_components(components):
+    """
+    The music21 duration components for a tied note made of `components` (in ticks, from
+    `split_durations`). They're immutable, so every note of the same length can share them.
+    """
+    try:
+        return _duration_components[components]
+    except KeyError:
+        d = Duration()
+        d.fill([to_quarters(c) for c in components])
+        _duration_components[components] = d.components
+        return d.components
+
+
+def note_specs(notes):
+    """
+    What it takes to notate a bar's worth of notes, as (pitches from `spelling.music21_pitch`, or
+    None for a rest, whether it's a chord, `duration_components`, or None for a grace note) for each
+    note
+    """
+    specs = []
+    components_list = split_durations([note['duration'] for note in notes])
+    for note, components in zip(notes, components_list):
+        pitch = note['pitch']
+        chord = isinstance(pitch, list)
+        if pitch == 'rest':
+            pitches = None
+        else:
+            pitches = tuple(spelling.music21_pitch(p) for p in (pitch if chord else [pitch]))
+        components = duration_components(components) if note['duration'] else None
+        specs.append((pitches, chord, components))
+    return specs
+
+
+def build_notes(specs):
+    """New music21 notes, chords and rests from `note_specs`"""
+    result = []
+    for pitches, chord, components in specs:
+        if pitches is None:
+            n = Rest()
+        elif chord:
+            n = Chord(notes=[Pitch(p) for p in pitches])
+        else:
+            n = Note(Pitch(pitches[0]))
+
+        # TODO add slurs
+        # TODO add glissandos
+        # TODO add -50 cent marks
+
+        if components is None:
+            d = Duration()
+            d.quarterLength = .5
+            d = d.getGraceDuration()
+        else:
+            d = Duration(components=components)
+        n.duration = d
+        result.append(n)
+    return result
+
+
+def notate_bar(bar, previous_duration, specs):
+    """
+    The music21 measures for a bar, as a list of (instrument name, measure). `specs` caches the
+    `note_specs` of each (bar type, part) between the bars of a song.
+    """
+    measures = []
+    for part in bar.parts:
+        measure = Measure()
+        if bar.tempo:
+            measure.insert(0, MetronomeMark(number=bar.tempo, referent=Duration(1)))
+            measure.leftBarline = 'double'
+        if bar.duration != previous_duration:
+            ts = TimeSignature('{}/4'.format(bar.duration))
+            measure.timeSignature = ts
+
+        key = (bar.type, part['instrument_name'])
+        if key not in specs:
+            specs[key] = note_specs(part['notes'])
+        for n in build_notes(specs[key]):
+            measure.append(n)
+
+        measures.append((part['instrument_name'], measure))
+    return measures
+
+
+def notate_song(song, previous_duration):
+    """
+    Make the music21 measures for a song, as a list for each bar of (instrument name, measure)
+
+    Every bar of a bar type shares the same notes, so spelling and splitting them is done once per
+    bar type and each repeat only builds fresh music21 objects (which can only be in one measure).
+    """
+    bars = []
+    specs = {}
+    for bar in song.bars:
+        bars.append(notate_bar(bar, previous_duration, specs))
+        previous_duration = bar.duration
+    return bars
@@ -0,0 +1,80 @@
+"""
+Decide which songs go in a piece before making any of them.
+
+A song's length only depends on its form and tempo, so those are drawn first for a pool of
+candidate songs, and then a subset-sum over their lengths picks the songs that come closest to
+the piece's target length. Only the chosen songs get harmonies and melodies.
+"""
+import random
+
+import form
+
+
+MIN_TEMPO = 55
+MAX_TEMPO = 80
+
+# Song lengths are added up in tenths of a second
+STEPS_PER_SECOND = 10
+
+
+def choose_tempo(rng=random):
+    return rng.randint(MIN_TEMPO, MAX_TEMPO)
+
+
+def candidates(rng, target_minutes):
+    """
+    Draw ((form string, tempo, seed), minutes) for candidate songs until there are twice as many
+    minutes of them as needed
+    """
+    catalogue = form.get_catalogue()
+    result = []
+    total = 0
+    while total < target_minutes * 2:
+        i = catalogue.choose_index(rng)
+        tempo = choose_tempo(rng)
+        minutes = catalogue.durations[i] / float(tempo)
+        result.append(((catalogue.forms[i], tempo, rng.getrandbits(32)), minutes))
+        total += minutes
+    return result
+
+
+def closest_subset(lengths, target):
+    """
+    Indexes of the `lengths` (non-negative ints) whose sum is closest to `target`, in order.
+    Every sum that can be reached is a bit in an int, so adding a length is one shift and or.
+    """
+    reachable = [1]
+    for length in lengths:
+        reachable.append(reachable[-1] | reachable[-1] << length)
+
+    sums = reachable[-1]
+    best = None
+    for distance in range(max(target, sums.bit_length()) + 1):
+        for total in (target - distance, target + distance):
+            if total >= 0 and sums >> total & 1:
+                best = total
+                break
+        if best is not None:
+            break
+
+    # Walk back, leaving out a song whenever the total can be reached without it
+    chosen = []
+    total = best
+    for i in range(len(lengths) - 1, -1, -1):
+        if not reachable[i] >> total & 1:
+            chosen.append(i)
+            total -= lengths[i]
+    chosen.reverse()
+    return chosen
+
+
+def plan(rng, target_minutes):
+    """
+    (form string, tempo, seed) for each song of a piece that lasts as close to
+    `target_minutes` as the candidates allow
+    """
+    songs = candidates(rng, target_minutes)
+    steps_per_minute = 60 * STEPS_PER_SECOND
+    lengths = [int(round(minutes * steps_per_minute)) for _, minutes in songs]
+    chosen = closest_subset(lengths, int(round(target_minutes * steps_per_minute)))
+    return [songs[i][0] for i in chosen]
@@ -1,16 +1,8 @@
-from utils import weighted_choice, scale_list
-
-
-class S(object):
-    def __init__(self, *args):
-        self.weighted_options = args
-
-    def choose(self):
-        weights, options = zip(*self.weighted_options)
-        choice = weighted_choice(options, weights)
-        if isinstance(choice, S):
-            return choice.choose()
-        return choice
+"""
+Unfinished sketch of meter-weighted rhythms. It doesn't compile (choose_accents has no body) and
+nothing imports it; melody_rhythm and harmonic_rhythm are what the package uses.
+"""
+from utils import weighted_choice, scale_list, S
 
 
 tree = S(
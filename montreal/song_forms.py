@@ -1,16 +1,31 @@
-import itertools
+import os
+import random
+import json
+import inspect
+import hashlib
 
-from utils import weighted_choice
+from collections import Counter
+
+from utils import WeightedSampler
+
+
+MIN_SECTIONS = 3
+MAX_SECTIONS = 5
+
+CACHE_DIR = os.environ.get(
+    'MONTREAL_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'montreal')
+)
 
 
 def validate(array):
     # Remove boring ones
     uniques = set(array)
     len_uniques = len(uniques)
-    if len_uniques < 3:
+    if len_uniques < MIN_SECTIONS:
         return False
     # Remove overly interesting ones
-    if len_uniques > 5:
+    if len_uniques > MAX_SECTIONS:
         return False
     # Remove illegal ones
     for index, item in enumerate(array[1:]):
@@ -28,10 +43,95 @@ def validate(array):
     return True
 
 
+def enumerate_forms(n):
+    """
+    Every form of length `n` that passes `validate`, in the order `itertools.product` would give them.
+
+    The "illegal ones" rule means a new section can only be one more than the highest so far,
+    so forms are built up directly as restricted growth strings and only valid ones come out.
+    """
+    forms = []
+    form = [0] * n
+
+    def extend(index, highest, good):
+        remaining = n - index
+        if highest + 1 + remaining < MIN_SECTIONS:
+            return
+        if remaining == 0:
+            if good:
+                forms.append(tuple(form))
+            return
+        for section in range(min(highest + 1, MAX_SECTIONS - 1) + 1):
+            form[index] = section
+            # Going back to a section that came before the latest one is what makes it good
+            extend(index + 1, max(highest, section), good or section < highest)
+
+    extend(0, -1, False)
+    return forms
+
+
+_hash = []
+
+
+def _rules_hash():
+    """
+    A hash of the rules, worked out once. None if their source can't be read (e.g. only .pyc files
+    were shipped), in which case nothing is cached on disk.
+    """
+    if not _hash:
+        try:
+            rules = [MIN_SECTIONS, MAX_SECTIONS, inspect.getsource(validate), inspect.getsource(enumerate_forms)]
+            _hash.append(hashlib.sha1(repr(rules)).hexdigest()[:12])
+        except (IOError, TypeError):
+            _hash.append(None)
+    return _hash[0]
+
+
+def _cache_path(n):
+    rules_hash = _rules_hash()
+    if rules_hash is None:
+        return None
+    return os.path.join(CACHE_DIR, 'song_forms-{}-{}.json'.format(rules_hash, n))
+
+
+def _read_cache(n):
+    path = _cache_path(n)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return [tuple(form) for form in json.load(f)]
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_cache(n, forms):
+    path = _cache_path(n)
+    if path is None:
+        return
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(tmp, 'w') as f:
+            json.dump(forms, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+_forms = {}
+
+
 def get_forms(n):
-    args = [range(i + 1) for i in range(n)]
-    product = itertools.product(*args)
-    return filter(validate, product)
+    """Valid forms of length `n`, worked out the first time they're asked for and cached on disk"""
+    if n not in _forms:
+        forms = _read_cache(n)
+        if forms is None:
+            forms = enumerate_forms(n)
+            _write_cache(n, forms)
+        _forms[n] = forms
+    return _forms[n]
 
 
 def build_form_weights_4():
@@ -46,13 +146,32 @@ def build_form_weights(n):
     for form in forms:
         if form[:4] == (0, 1, 2, 0):
             weights.append(1)
-        if form[:4] == (0, 1, 2, 3):
+        elif form[:4] == (0, 1, 2, 3):
             weights.append(1)
         else:
             weights.append(8)
     return forms, weights
 
 
+def legacy_fallback_probability(forms):
+    """
+    The chance that a draw from this group went through the old retry in `choose`.
+
+    `build_form_weights` used to have an `if` where it meant `elif`, so forms starting
+    (0, 1, 2, 0) got two weights. The weights list came out longer than the forms list and any
+    draw that landed past the end of the forms failed and was retried.
+    """
+    weights = []
+    for form in forms:
+        if form[:4] == (0, 1, 2, 0):
+            weights.append(1)
+        if form[:4] == (0, 1, 2, 3):
+            weights.append(1)
+        else:
+            weights.append(8)
+    return float(sum(weights[len(forms):])) / sum(weights)
+
+
 def build_group_weights():
     weights = [11, 3, 5, 2, 9, 1]
     options = [
@@ -66,14 +185,33 @@ def build_group_weights():
     return options, weights
 
 
-GROUP_OPTIONS, GROUP_WEIGHTS = build_group_weights()
+class FormGroup(WeightedSampler):
+    def __init__(self, forms, weights, legacy_fallback_probability=0.0):
+        # Raises if the weights don't line up with the forms
+        super(FormGroup, self).__init__(forms, weights)
+        self.legacy_fallback_probability = legacy_fallback_probability
+
+
+GROUPS = None
+
+# How many forms have been drawn, and how many of those draws would have hit the old retry
+# (an expected count, since the new draws never fail)
+stats = Counter()
+
 
+def get_groups():
+    global GROUPS
+    if GROUPS is None:
+        options, weights = build_group_weights()
+        # The hand written group of 4 always lined up
+        legacy = [0.0] + [legacy_fallback_probability(get_forms(n)) for n in range(5, 10)]
+        groups = [FormGroup(forms, form_weights, p) for (forms, form_weights), p in zip(options, legacy)]
+        GROUPS = WeightedSampler(groups, weights)
+    return GROUPS
 
-def choose():
-    try:  # TODO HOLY SHIT REMOVE THIS. infinite loop danger. find actual bug.
-        forms, weights = weighted_choice(GROUP_OPTIONS, GROUP_WEIGHTS)
-        return weighted_choice(forms, weights)
-    except:
-        print 'warning!  song_forms.choose failed and retried.'
-        return choose()
 
+def choose(rng=random):
+    group = get_groups().choose(rng)
+    stats['draws'] += 1
+    stats['legacy_fallbacks'] += group.legacy_fallback_probability
+    return group.choose(rng)
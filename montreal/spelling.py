@@ -0,0 +1,67 @@
+"""
+Force-flat pitch spelling, worked out once per pitch number instead of once per note.
+
+    Pitch(spelling.music21_pitch(61))  # Pitch('D-4')
+    Pitch(spelling.music21_pitch(61.5))  # Pitch('D`4')
+    spelling.xml_pitch(61.5)  # ('D', -.5, 4)
+"""
+
+
+# Force all flats
+STEPS = [
+    ('C', 0),
+    ('D', -1),
+    ('D', 0),
+    ('E', -1),
+    ('E', 0),
+    ('F', 0),
+    ('G', -1),
+    ('G', 0),
+    ('A', -1),
+    ('A', 0),
+    ('B', -1),
+    ('B', 0)
+]
+
+# music21's accidental for each alter
+MODIFIERS = {
+    -1: '-',
+    -.5: '`',
+    .5: '~'
+}
+
+_music21 = {}
+_xml = {}
+
+
+def music21_pitch(pitch):
+    """
+    What to make a music21 `Pitch` from to force all flats: the pitch number itself if it's a
+    natural, otherwise the name of `xml_pitch`'s spelling (quicker to parse than respelling every
+    time), so both exports spell quarter tones the same way
+    """
+    try:
+        return _music21[pitch]
+    except KeyError:
+        step, alter, octave = xml_pitch(pitch)
+        if alter:
+            spelled = '{}{}{}'.format(step, MODIFIERS[alter], octave)
+        else:
+            spelled = pitch
+        _music21[pitch] = spelled
+        return spelled
+
+
+def xml_pitch(pitch):
+    """(step, alter, octave) for a pitch number, quarter tones a quarter tone above the flat spelling"""
+    try:
+        return _xml[pitch]
+    except KeyError:
+        semitone = int(pitch // 1)
+        step, alter = STEPS[semitone % 12]
+        octave = semitone // 12 - 1
+        if pitch != semitone:
+            alter += .5
+        _xml[pitch] = spelled = (step, alter, octave)
+        return spelled
+
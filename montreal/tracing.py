@@ -0,0 +1,227 @@
+"""
+Opt-in timing of the stages of making a piece.
+
+    tracer = Tracer()
+    piece = Piece(tracer=tracer)
+    print tracer.summary()
+    print tracer.summary(by='form')
+    tracer.write_json('trace.json')
+    tracer.write_chrome_trace('trace.chrome.json')  # open in chrome://tracing or Perfetto
+
+Spans nest, and a span picks up the tags of the span it's inside, so a 'melody' span inside a
+'song' span tagged with the song's form and tempo can be grouped by form or tempo.
+
+Without a tracer everything goes through `NULL_TRACER`, which does nothing.
+"""
+import os
+import sys
+import json
+from timeit import default_timer
+from collections import defaultdict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def now_ns():
+    return int(default_timer() * 1e9)
+
+
+def traced_memory():
+    """Bytes allocated through Python and still in use, from tracemalloc"""
+    return tracemalloc.get_traced_memory()[0]
+
+
+def peak_rss():
+    """The process's peak resident set size in bytes, for Pythons without tracemalloc"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, macOS in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Span(object):
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.pid = os.getpid()
+        self.depth = 0
+        self.start_ns = None
+        self.duration_ns = None
+        self.allocated_bytes = None
+        self._start_memory = None
+
+    def tag(self, **tags):
+        """Add tags to this span, and to any spans started inside it from now on"""
+        self.tags.update(tags)
+
+    def __enter__(self):
+        tracer = self.tracer
+        if tracer.stack:
+            parent = tracer.stack[-1]
+            tags = dict(parent.tags)
+            tags.update(self.tags)
+            self.tags = tags
+            self.depth = parent.depth + 1
+        tracer.stack.append(self)
+        if tracer.allocations:
+            self._start_memory = tracer.memory()
+        self.start_ns = now_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration_ns = now_ns() - self.start_ns
+        if self._start_memory is not None:
+            self.allocated_bytes = self.tracer.memory() - self._start_memory
+        self.tracer.stack.pop()
+        self.tracer.spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'tags': self.tags,
+            'pid': self.pid,
+            'depth': self.depth,
+            'start_ns': self.start_ns,
+            'duration_ns': self.duration_ns,
+            'allocated_bytes': self.allocated_bytes
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tracer'] = None
+        return state
+
+
+class Tracer(object):
+    """
+    Collects spans. With `allocations=True` each span also records how much memory it took, in
+    `allocated_bytes`: the change in memory traced by tracemalloc where there is one (Python 3),
+    otherwise the growth of the process's peak RSS (`memory_source` says which). That's coarser,
+    since it only moves when a span pushes memory past its high point.
+    """
+    enabled = True
+
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.memory_source = None
+        self.memory = None
+        if allocations:
+            if tracemalloc is not None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                self.memory_source, self.memory = 'tracemalloc', traced_memory
+            elif resource is not None:
+                self.memory_source, self.memory = 'peak_rss', peak_rss
+            else:
+                raise RuntimeError('Allocations need tracemalloc or the resource module')
+        self.spans = []
+        self.stack = []
+
+    def span(self, name, **tags):
+        return Span(self, name, tags)
+
+    def child(self):
+        """A fresh tracer with the same settings, e.g. for a worker process"""
+        return Tracer(self.allocations)
+
+    def merge(self, other, **tags):
+        """Add the spans from another tracer (e.g. one sent back from a worker process)"""
+        for span in other.spans:
+            span.tracer = self
+            span.tags.update(tags)
+            self.spans.append(span)
+
+    def summary(self, by=None):
+        """
+        Count, total and max nanoseconds (and allocated bytes) per span name,
+        or per (tag value, span name) if `by` is the name of a tag.
+        """
+        totals = defaultdict(lambda: {'count': 0, 'total_ns': 0, 'max_ns': 0, 'allocated_bytes': 0})
+        for span in self.spans:
+            key = span.name if by is None else (span.tags.get(by), span.name)
+            total = totals[key]
+            total['count'] += 1
+            total['total_ns'] += span.duration_ns
+            total['max_ns'] = max(total['max_ns'], span.duration_ns)
+            if span.allocated_bytes is not None:
+                total['allocated_bytes'] += span.allocated_bytes
+        return dict(totals)
+
+    def to_json(self):
+        return {
+            'memory_source': self.memory_source,
+            'spans': [span.to_dict() for span in self.spans],
+            'summary': self.summary()
+        }
+
+    def chrome_trace(self):
+        """The spans in Chrome's trace event format, as complete ('X') events in microseconds"""
+        events = []
+        for span in self.spans:
+            args = dict(span.tags)
+            if span.allocated_bytes is not None:
+                args['allocated_bytes'] = span.allocated_bytes
+            events.append({
+                'name': span.name,
+                'ph': 'X',
+                'ts': span.start_ns / 1000.0,
+                'dur': span.duration_ns / 1000.0,
+                'pid': span.pid,
+                'tid': span.pid,
+                'args': args
+            })
+        events.sort(key=lambda e: e['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f, default=str)
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+
+class NullSpan(object):
+    def tag(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullTracer(object):
+    """Stands in for a `Tracer` when nobody is tracing. Costs a method call per span."""
+    enabled = False
+    spans = ()
+
+    def __init__(self):
+        self._span = NullSpan()
+
+    def span(self, name, **tags):
+        return self._span
+
+    def child(self):
+        return self
+
+    def merge(self, other, **tags):
+        pass
+
+    def __reduce__(self):
+        # Unpickles as the same NULL_TRACER
+        return 'NULL_TRACER'
+
+
+NULL_TRACER = NullTracer()
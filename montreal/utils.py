@@ -1,6 +1,21 @@
 import random
+from bisect import bisect_left, bisect_right
 from itertools import combinations, groupby
-from collections import Counter, defaultdict
+from collections import Counter
+from fractions import Fraction
+
+
+# Offsets and durations of notes, harmonies, bars and forms are counted in integer ticks.
+# Convert to quarter lengths only when handing things over to music21.
+TICKS_PER_QUARTER = 480
+
+
+def to_ticks(quarter_length):
+    return int(round(quarter_length * TICKS_PER_QUARTER))
+
+
+def to_quarters(ticks):
+    return float(ticks) / TICKS_PER_QUARTER
 
 
 def scale(x, minimum, maximum, floor=0, ceiling=1):
@@ -13,8 +28,8 @@ def scale_list(l, floor=0, ceiling=1):
     return [scale(x, minimum, maximum, floor, ceiling) for x in l]
 
 
-def weighted_choice(options, weights):
-    rand = random.random()
+def weighted_choice(options, weights, rng=random):
+    rand = rng.random()
     rand = scale(rand, 0, 1, 0, sum(weights))
     total = 0
     for i, weight in enumerate(weights):
@@ -23,6 +38,84 @@ def weighted_choice(options, weights):
             return options[i]
 
 
+class WeightedSampler(object):
+    """Draw from a fixed set of weighted options in constant time.
+
+    The alias tables (Vose's method) are built once, so use this instead of
+    `weighted_choice` for any table that gets drawn from more than once.
+    """
+
+    def __init__(self, options, weights):
+        options = list(options)
+        weights = [float(w) for w in weights]
+        if len(options) != len(weights):
+            raise ValueError('{} options but {} weights'.format(len(options), len(weights)))
+        if not options:
+            raise ValueError('WeightedSampler needs at least one option')
+        if any(w < 0 for w in weights):
+            raise ValueError('weights must not be negative')
+        total = sum(weights)
+        if total <= 0:
+            raise ValueError('weights must not all be zero')
+
+        self.options = options
+        self.weights = weights
+        self.n = n = len(options)
+
+        prob = [0.0] * n
+        alias = list(range(n))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever is left over is 1.0 give or take float error
+        for i in large + small:
+            prob[i] = 1.0
+
+        self.prob = prob
+        self.alias = alias
+
+    def choose(self, rng=random):
+        u = rng.random() * self.n
+        i = int(u)
+        if i == self.n:
+            i -= 1
+        if u - i < self.prob[i]:
+            return self.options[i]
+        return self.options[self.alias[i]]
+
+    def sample(self, n, rng=random):
+        """Make `n` independent draws"""
+        options = self.options
+        prob = self.prob
+        alias = self.alias
+        size = self.n
+        rand = rng.random
+        result = []
+        for _ in range(n):
+            u = rand() * size
+            i = int(u)
+            if i == size:
+                i -= 1
+            if u - i < prob[i]:
+                result.append(options[i])
+            else:
+                result.append(options[alias[i]])
+        return result
+
+    def __len__(self):
+        return self.n
+
+
 def fibonacci(n):
     a, b = 0, 1
     for x in range(n):
@@ -33,13 +126,13 @@ def fibonacci(n):
 GOLDEN_MEAN = float(fibonacci(30)) / fibonacci(31)
 
 
-def divide(dur, units):
+def divide(dur, units, rng=random):
     """Divide the length `dur` into `units` sections"""
     if units > dur:
         return "hey, you can't divide `dur` into a number of units greater than `dur`"
     divs = []
     while len(divs) < units - 1:
-        r = random.randint(1, dur - 1)
+        r = rng.randint(1, dur - 1)
         if r not in divs:
             divs.append(r)
     divs.sort()
@@ -53,29 +146,33 @@ def divide(dur, units):
     return result
 
 
-def fill(dur, min_note_dur=1):
+def fill(dur, min_note_dur=1, rng=random):
     """put a single duration within a larger duration with a rest at the beggining, end, or both"""
-    note_dur = random.randint(1, dur - 1)
-    start = random.randint(0, dur - note_dur)
+    note_dur = rng.randint(1, dur - 1)
+    start = rng.randint(0, dur - note_dur)
     rest_1_dur = start
     rest_2_dur = dur - (start + note_dur)
     return rest_1_dur, note_dur, rest_2_dur
 
 
 def frange(x, y, step=1.0):
-    while x < y:
-        yield x
-        x += step
+    # Multiply instead of adding up `step` so long ranges don't drift
+    i = 0
+    value = x
+    while value < y:
+        yield value
+        i += 1
+        value = x + i * step
 
 
-def random_split(items):
+def random_split(items, rng=random):
     len_items = len(items)
-    len_a = random.randint(1, len_items - 1)
+    len_a = rng.randint(1, len_items - 1)
     len_b = len_items - len_a
-    a = random.sample(items, len_a)
+    a = rng.sample(items, len_a)
     for item in a:
         items.remove(item)
-    b = random.sample(items, len_b)
+    b = rng.sample(items, len_b)
     return a, b
 
 
@@ -88,6 +185,22 @@ def count_intervals(harmony):
     return counter
 
 
+def pitch_class_mask(pitches):
+    """A 12-bit mask with bit n set for each pitch class n among `pitches`"""
+    mask = 0
+    for p in pitches:
+        mask |= 1 << int(p) % 12
+    return mask
+
+
+def pitch_bits(pitches):
+    """A bitset with bit n set for each (whole semitone) pitch n among `pitches`"""
+    bits = 0
+    for p in pitches:
+        bits |= 1 << int(p)
+    return bits
+
+
 def subdivide(n, biggest=4):
     """Break down `n` into as many units the size of `biggest` as possible then tack on the remainder"""
     result = []
@@ -102,54 +215,85 @@ def subdivide(n, biggest=4):
 
 def split_at_offsets(dur, offsets):
     """split a single duration at offsets."""
-    if len(offsets) == 0:
-        return [dur]
-
     components = []
-    offsets.append(dur)
     start = 0
     for offset in offsets:
         components.append(offset - start)
         start = offset
-
+    components.append(dur - start)
     return components
 
 
-def split_at_beats(note_durs):
-    """Split a list of durations at quarter notes."""
-    beat_indexes = list(frange(0, sum(note_durs)))
+def _beat_components(start, dur):
+    """Split the note from `start` to `start + dur` (in ticks) at every beat it crosses"""
+    end = start + dur
+    next_beat = (start // TICKS_PER_QUARTER + 1) * TICKS_PER_QUARTER
+    while next_beat < end:
+        yield next_beat - start
+        start = next_beat
+        next_beat += TICKS_PER_QUARTER
+    yield end - start
 
-    total = 0
+
+def split_at_beats(note_durs):
+    """Split a list of durations in ticks at quarter notes."""
     components = []
+    start = 0
     for dur in note_durs:
-        start = total
-        end = total + dur
-
-        split_at = []
-        for beat in beat_indexes:
-            if start < beat < end:
-                split_point = beat - start
-                split_at.append(split_point)
-
-        note_components = split_at_offsets(dur, split_at)
-        components.append(note_components)
-        total += dur
-
+        components.append(list(_beat_components(start, dur)))
+        start += dur
     return components
 
 
 def join_quarters(dur_components):
-    """For duration components of a single note, join together any adjacent quarter note components"""
+    """For duration components (in ticks) of a single note, join together any adjacent quarter note components"""
     new_durs = []
     for key, group in groupby(dur_components):
-        new_dur = key
         len_group = len(list(group))
-        if key == 1.0 and len_group > 1:
-            new_dur = float(len_group)
-        new_durs.append(new_dur)
+        if key == TICKS_PER_QUARTER and len_group > 1:
+            new_durs.append(TICKS_PER_QUARTER * len_group)
+        else:
+            new_durs.extend([key] * len_group)
     return new_durs
 
 
+_split_durations_cache = {}
+
+
+def split_durations(note_durs):
+    """
+    `split_at_beats` and `join_quarters` in one pass.
+
+    Returns a tuple with a tuple of tied duration components (in ticks) for each note.
+    Results are memoized on the durations, since the same bar rhythms come up again and again.
+    """
+    key = tuple(note_durs)
+    result = _split_durations_cache.get(key)
+    if result is not None:
+        return result
+
+    result = []
+    start = 0
+    for dur in key:
+        components = []
+        quarters = 0
+        for component in _beat_components(start, dur):
+            if component == TICKS_PER_QUARTER:
+                quarters += 1
+                continue
+            if quarters:
+                components.append(quarters * TICKS_PER_QUARTER)
+                quarters = 0
+            components.append(component)
+        if quarters:
+            components.append(quarters * TICKS_PER_QUARTER)
+        result.append(tuple(components))
+        start += dur
+
+    result = _split_durations_cache[key] = tuple(result)
+    return result
+
+
 def get_inversions(chord):
     inversions = []
     for p1 in chord:
@@ -159,24 +303,103 @@ def get_inversions(chord):
     return inversions
 
 
+def exact(weight):
+    """Weights are written as decimal literals, so read .3 as 3/10 rather than its binary approximation"""
+    if isinstance(weight, float):
+        return Fraction(repr(weight))
+    return Fraction(weight)
+
+
 class S(object):
+    """A tree of weighted options, where an option can be another `S`"""
     def __init__(self, *args):
         self.weighted_options = args
+        self.sampler = None
+
+    def leaves(self):
+        """Flatten the tree into a list of (probability, option) with exact probabilities"""
+        total = sum(exact(weight) for weight, _ in self.weighted_options)
+        result = []
+        for weight, option in self.weighted_options:
+            probability = exact(weight) / total
+            if isinstance(option, S):
+                for leaf_probability, leaf in option.leaves():
+                    result.append((probability * leaf_probability, leaf))
+            else:
+                result.append((probability, option))
+        return result
+
+    def compile(self):
+        """Fold the whole tree into a single flat sampler over its leaves"""
+        if self.sampler is None:
+            probabilities, options = zip(*self.leaves())
+            self.sampler = WeightedSampler(options, probabilities)
+        return self.sampler
+
+    def choose(self, rng=random):
+        return self.compile().choose(rng)
+
+
+class Event(object):
+    """
+    A note, chord, rest or grace note in a part. `pitch` is a pitch number, a list of them for a
+    chord, or 'rest'. `duration` is in ticks (0 for a grace note) and `start` is the offset in ticks
+    from the start of the bar once `set_start_end` has been run; `end` is worked out from them.
 
-    def choose(self):
-        weights, options = zip(*self.weighted_options)
-        choice = weighted_choice(options, weights)
-        if isinstance(choice, S):
-            return choice.choose()
-        return choice
+    Slots keep thousands of songs' worth of notes small, but they still read and write like the
+    dicts they replaced (`note['pitch']`, `note.get('ornaments')`), so functions here take either.
+    """
+    __slots__ = ('pitch', 'duration', 'start', 'ornaments', 'pitch_classes', 'pitch_class_mask')
+
+    def __init__(self, pitch=None, duration=0, start=None):
+        self.pitch = pitch
+        self.duration = duration
+        self.start = start
+        self.ornaments = None
+        self.pitch_classes = None
+        self.pitch_class_mask = None
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return 'Event(pitch={!r}, duration={!r}, start={!r})'.format(self.pitch, self.duration, self.start)
 
 
 def set_start_end(notes):
+    """
+    Set the start offsets in ticks of a line of notes with durations in ticks, and the end offsets
+    of plain dicts (an `Event` works out its own)
+    """
     offset = 0
     for note in notes:
         note['start'] = offset
-        note['end'] = offset + note['duration']
         offset += note['duration']
+        if not isinstance(note, Event):
+            note['end'] = offset
 
 
 def get_at(offset, notes):
@@ -185,64 +408,198 @@ def get_at(offset, notes):
             return note
 
 
-def get_simul(lists_of_notes):
+class Timeline(object):
+    """
+    Read-only index over a single line of notes that have been through `set_start_end`.
+
+    Notes must be back to back (no overlaps), which is what `set_start_end` produces.
+    Zero length notes (grace notes) never sound at an offset so they are left out.
     """
-    lists_of_notes must be a list of lists of dictionaries with duration and pitch attributes
+    def __init__(self, notes):
+        self.notes = tuple(note for note in notes if note['end'] > note['start'])
+        self.starts = tuple(note['start'] for note in self.notes)
+        self.ends = tuple(note['end'] for note in self.notes)
+
+    def at(self, offset):
+        """The note sounding at `offset`, like `get_at`"""
+        i = bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < self.ends[i]:
+            return self.notes[i]
+
+    def overlapping(self, start, end):
+        """All notes sounding at any point in [start, end)"""
+        if end <= start:
+            return ()
+        first = bisect_right(self.ends, start)
+        last = bisect_left(self.starts, end)
+        return self.notes[first:last]
+
+    def __len__(self):
+        return len(self.notes)
+
+
+SIXTEENTH = TICKS_PER_QUARTER // 4
+
+
+def _slice_index(offset, slice_ticks):
+    """Index of the first slice that starts at or after `offset`"""
+    return -(-offset // slice_ticks)
+
+
+def get_simul(lists_of_notes, slice_ticks=SIXTEENTH):
+    """
+    lists_of_notes must be a list of lists of dictionaries with duration (in ticks) and pitch attributes
+
+    Returns the pitches sounding in each 16th note slice (by default) of the first part's duration.
+    Sweeps across the note boundaries (starts and ends) of all the parts at once, so each stretch
+    of time where nothing changes is only worked out once. Gives the same as `_get_simul_scan`.
     """
     for part in lists_of_notes:
-        offset = 0
-        for note in part:
-            note['start'] = offset
-            note['end'] = offset + note['duration']
-            offset += note['duration']
+        set_start_end(part)
 
-    beat_map = defaultdict(list)
     duration = sum([note['duration'] for note in lists_of_notes[0]])
-    for offset in frange(0, duration, .25):
-        for part in lists_of_notes:
-            for note in part:
-                if note['start'] <= offset < note['end']:
-                    beat_map[offset].append(note)
+    num_slices = _slice_index(duration, slice_ticks)
 
+    boundaries = set([0, num_slices])
+    for part in lists_of_notes:
+        for note in part:
+            # Ends too, or a part that stops before the first one would keep sounding
+            for offset in (note['start'], note['end']):
+                index = _slice_index(offset, slice_ticks)
+                if index < num_slices:
+                    boundaries.add(index)
+    boundaries = sorted(boundaries)
+
+    positions = [0] * len(lists_of_notes)
     simuls = []
-    for beat in frange(0, duration, .25):
+    for first, last in zip(boundaries[:-1], boundaries[1:]):
+        offset = first * slice_ticks
         simul = []
-        for note in beat_map[beat]:
-            pitch = note['pitch']
+        seen = set()
+        for part_index, part in enumerate(lists_of_notes):
+            i = positions[part_index]
+            while i < len(part) and part[i]['end'] <= offset:
+                i += 1
+            positions[part_index] = i
+            if i == len(part) or part[i]['start'] > offset:
+                continue
+            pitch = part[i]['pitch']
             if not isinstance(pitch, list):
                 pitch = [pitch]
             for p in pitch:
-                if p not in simul:
+                if p not in seen:
+                    seen.add(p)
                     simul.append(p)
+        for _ in range(first, last):
+            simuls.append(list(simul))
+    return simuls
+
+
+def _get_simul_scan(lists_of_notes, slice_ticks=SIXTEENTH):
+    """The slow way to do `get_simul`, checking every note at every slice, for checking it against"""
+    for part in lists_of_notes:
+        set_start_end(part)
+
+    duration = sum([note['duration'] for note in lists_of_notes[0]])
+    simuls = []
+    for index in range(_slice_index(duration, slice_ticks)):
+        offset = index * slice_ticks
+        simul = []
+        for part in lists_of_notes:
+            for note in part:
+                if note['start'] <= offset < note['end']:
+                    pitch = note['pitch']
+                    if not isinstance(pitch, list):
+                        pitch = [pitch]
+                    for p in pitch:
+                        if p not in simul:
+                            simul.append(p)
         simuls.append(simul)
     return simuls
 
 
+def check_get_simul(trials=500, rng=random):
+    """Raise AssertionError unless `get_simul` matches `_get_simul_scan` on random parts"""
+    pitches = [60, 62, 64, 'rest', [60, 64], [62, 67]]
+    durations = [0, 60, 120, 240, 300, 360, 480, 960]
+    for _ in range(trials):
+        parts = []
+        for _ in range(rng.randint(1, 3)):
+            parts.append([{'pitch': rng.choice(pitches), 'duration': rng.choice(durations)}
+                          for _ in range(rng.randint(1, 6))])
+        expected = _get_simul_scan(parts)
+        actual = get_simul(parts)
+        assert actual == expected, (parts, actual, expected)
 
 
+def _numpy():
+    """numpy, imported the first time a piano roll needs it rather than whenever utils is"""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('piano rolls need numpy')
+    return numpy
 
 
-    beat_map = defaultdict(list)
-    for part in lists_of_notes:
-        beat = 0
-        for note in part:
-            dur = note['duration']
-            for b in frange(0, dur, .25):
-                if note['pitch'] != 'rest':
-                    beat_map[beat].append(note)
-                beat += .25
+def piano_roll(lists_of_notes, quarter_tones=False, slice_ticks=SIXTEENTH):
+    """
+    Boolean numpy array of slices x pitches, True where a pitch is sounding.
 
-    print beat_map
+    There are 128 pitch columns, or 256 with `quarter_tones` so that the 0.5 steps of
+    `all_notes_24` get their own column (column = pitch * 2). Rests are left out.
+    """
+    numpy = _numpy()
+    for part in lists_of_notes:
+        set_start_end(part)
 
-    simuls = []
-    for beat in beat_map:
-        simul = []
-        for note in beat_map[beat]:
+    steps = 2 if quarter_tones else 1
+    duration = sum([note['duration'] for note in lists_of_notes[0]])
+    num_slices = _slice_index(duration, slice_ticks)
+    roll = numpy.zeros((num_slices, 128 * steps), dtype=bool)
+    for part in lists_of_notes:
+        for note in part:
             pitch = note['pitch']
+            if pitch is None or pitch == 'rest':
+                continue
             if not isinstance(pitch, list):
                 pitch = [pitch]
-            for p in pitch:
-                if p not in simul:
-                    simul.append(p)
-        simuls.append(simul)
-    return simuls
\ No newline at end of file
+            first = _slice_index(note['start'], slice_ticks)
+            last = min(_slice_index(note['end'], slice_ticks), num_slices)
+            if first < last:
+                columns = [int(round(p * steps)) for p in pitch]
+                roll[first:last, columns] = True
+    return roll
+
+
+def roll_simuls(roll):
+    """The sounding pitches of each slice of a `piano_roll`, lowest first"""
+    numpy = _numpy()
+    steps = roll.shape[1] // 128
+    return [[float(c) / steps if steps > 1 else c for c in numpy.flatnonzero(row)] for row in roll]
+
+
+def roll_pitch_classes(roll):
+    """Fold a `piano_roll` into slices x 12 (or 24 for quarter tones) pitch classes"""
+    numpy = _numpy()
+    octave = 12 * (roll.shape[1] // 128)
+    num_octaves = -(-roll.shape[1] // octave)
+    padded = numpy.zeros((roll.shape[0], num_octaves * octave), dtype=bool)
+    padded[:, :roll.shape[1]] = roll
+    return padded.reshape(roll.shape[0], num_octaves, octave).any(axis=1)
+
+
+def roll_interval_counts(roll):
+    """
+    Slices x 12 (or 24) counts of the intervals between the pitch classes sounding in each
+    slice, counted the same way as `count_intervals`. Column `i` is the number of intervals of
+    size `i`; column 0 is always 0.
+    """
+    numpy = _numpy()
+    pitch_classes = roll_pitch_classes(roll).astype(int)
+    octave = pitch_classes.shape[1]
+    counts = numpy.zeros(pitch_classes.shape, dtype=int)
+    for interval in range(1, octave):
+        counts[:, interval] = (pitch_classes[:, :octave - interval] * pitch_classes[:, interval:]).sum(axis=1)
+        # `count_intervals` also counts up to the octave above the lowest pitch class
+        counts[:, interval] += pitch_classes[:, octave - interval]
+    return counts